@@ -21,34 +21,157 @@ from __future__ import print_function
 
 import argparse
 import glob
+import hashlib
+import json
+import multiprocessing
 import os
 import platform
 import shutil
+import socket
 import sys
 import tempfile
+import threading
 import time
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree as ET
 
 import pymod2pkg
 
 import sh
 from sh import Command
 
-
-def pymodule2pkg(spectemplate):
+try:
+    from urllib.error import URLError
+except ImportError:
+    from urllib2 import URLError
+
+try:
+    from download_cache import DownloadCache, spec_source_urls
+except ImportError:
+    # download_cache.py, from the gerrit scripts of the automation
+    # repository, is not on the python path (the openstack-rpm-packaging
+    # jobs add it), fall back to the plain download_files cache
+    DownloadCache = None
+
+
+# Python module to package name mappings are cached on disk, for each
+# pymod2pkg version and distribution
+PYMOD2PKG_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "createproject", "pymod2pkg.json")
+_DISTRO = []
+_PYMOD2PKG_MAP = {}
+
+
+def get_distro():
+    """Determine the distribution name (only once)"""
+    if not _DISTRO:
+        _DISTRO.append(platform.linux_distribution()[0] or 'suse')
+    return _DISTRO[0]
+
+
+def get_pymod2pkg_version():
+    version = getattr(pymod2pkg, '__version__', None)
+    if not version:
+        try:
+            import pkg_resources
+            version = pkg_resources.get_distribution('pymod2pkg').version
+        except Exception:
+            version = str(os.path.getmtime(pymod2pkg.__file__))
+    return version
+
+
+def _load_pymod2pkg_map():
+    if not _PYMOD2PKG_MAP:
+        key = '%s:%s' % (get_pymod2pkg_version(), get_distro())
+        try:
+            with open(PYMOD2PKG_CACHE) as cache_file:
+                cache = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            cache = {}
+        # mappings cached for other versions or distributions are discarded
+        _PYMOD2PKG_MAP.update(key=key, modules=cache.get(key, {}))
+    return _PYMOD2PKG_MAP
+
+
+def _save_pymod2pkg_map():
+    try:
+        if not os.path.isdir(os.path.dirname(PYMOD2PKG_CACHE)):
+            os.makedirs(os.path.dirname(PYMOD2PKG_CACHE))
+        # concurrent runs write their own temporary file, which atomically
+        # replaces the cache
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(PYMOD2PKG_CACHE), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump(
+                    {_PYMOD2PKG_MAP['key']: _PYMOD2PKG_MAP['modules']},
+                    cache_file, indent=2, sort_keys=True)
+            os.rename(tmp_path, PYMOD2PKG_CACHE)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    except (IOError, OSError) as e:
+        print('WARNING: could not save the pymod2pkg cache: %s' % e)
+
+
+def spectemplate2module(spectemplate):
     specname = os.path.splitext(spectemplate)[0]
-    modulename = os.path.splitext(os.path.basename(specname))[0]
-    pkgname = pymod2pkg.module2package(
-        modulename, platform.linux_distribution()[0] or 'suse')
-    if modulename == 'openstack-macros':
-        pkgname = modulename
-
-    return pkgname
+    return os.path.splitext(os.path.basename(specname))[0]
+
+
+def pymodules2pkgs(spectemplates):
+    """
+    Map spec templates to package names, using the cached mappings where
+    available and updating the cache with new ones.
+
+    :return: dict mapping spec templates to package names
+    """
+    pymod2pkg_map = _load_pymod2pkg_map()
+    modules = pymod2pkg_map['modules']
+    updated = False
+    pkgnames = {}
+    for spectemplate in spectemplates:
+        modulename = spectemplate2module(spectemplate)
+        if modulename not in modules:
+            if modulename == 'openstack-macros':
+                modules[modulename] = modulename
+            else:
+                modules[modulename] = pymod2pkg.module2package(
+                    modulename, get_distro())
+            updated = True
+        pkgnames[spectemplate] = modules[modulename]
+    if updated:
+        _save_pymod2pkg_map()
+    return pkgnames
+
+
+# Read-only and metadata OBS API calls are made in-process, through the osc
+# library, instead of spawning an osc process for each of them. The osc
+# command line tool is only used for operations involving local checkouts.
+# The obs_api client of the gerrit scripts is not used here: it is read-only,
+# while this script also updates project metadata and freezes links, and
+# the gerrit scripts are only an optional dependency of this script, so osc
+# would still be needed when they are not on the python path.
+_OSC_APIURL = []
+
+
+def get_osc_apiurl():
+    """Load the osc configuration (only once) and return the API URL"""
+    if not _OSC_APIURL:
+        import osc.conf
+        osc.conf.get_config()
+        _OSC_APIURL.append(osc.conf.config['apiurl'])
+    return _OSC_APIURL[0]
+
+
+def osc_api_url(*path, **query):
+    import osc.core
+    return osc.core.makeurl(get_osc_apiurl(), list(path), query=query)
 
 
 def get_osc_user():
     import osc.conf
-    osc.conf.get_config()
-    return osc.conf.get_apiurl_usr(osc.conf.config['apiurl'])
+    return osc.conf.get_apiurl_usr(get_osc_apiurl())
 
 
 def upload_meta(project, build_repository, linkproject):
@@ -86,32 +209,31 @@ Project used: %(ZUUL_PROJECT)s
                   'projectlink': projectlink,
                   'build_repository': build_repository})
 
-    with tempfile.NamedTemporaryFile() as meta:
-        meta.write(templ.encode('UTF-8'))
-        meta.flush()
-        print('Updating meta for ', project)
-
-        # work around build service bug that forgets the publish flag
-        # https://github.com/openSUSE/open-build-service/issues/7126
-        for success_counter in range(2):
-            # work around build service bug that triggers a database deadlock
-            for fail_counter in range(1, 5):
-                try:
-                    sh.osc('api', '-T', meta.name,
-                           '/source/%s/_meta' % project)
-                    break
-                except sh.ErrorReturnCode_1:
-                    # Sleep a bit and try again. This has not been
-                    # scientifically proven to be the correct sleep factor,
-                    # but it seems to work
-                    time.sleep(2)
-                    continue
-
-            # wait for the source service to catch up with creation
-            if success_counter == 0:
-                # Sleep a bit and try again. This has not been scientifically
-                # proven to be the correct sleep factor, but it seems to work
-                time.sleep(3)
+    import osc.core
+    print('Updating meta for ', project)
+
+    # work around build service bug that forgets the publish flag
+    # https://github.com/openSUSE/open-build-service/issues/7126
+    for success_counter in range(2):
+        # work around build service bug that triggers a database deadlock
+        for fail_counter in range(1, 5):
+            try:
+                osc.core.http_PUT(osc_api_url('source', project, '_meta'),
+                                  data=templ.encode('UTF-8'))
+                break
+            except (osc.core.HTTPError, URLError, socket.error):
+                # HTTP errors, but also connection errors and timeouts.
+                # Sleep a bit and try again. This has not been
+                # scientifically proven to be the correct sleep factor,
+                # but it seems to work
+                time.sleep(2)
+                continue
+
+        # wait for the source service to catch up with creation
+        if success_counter == 0:
+            # Sleep a bit and try again. This has not been scientifically
+            # proven to be the correct sleep factor, but it seems to work
+            time.sleep(3)
 
 
 def upload_meta_enable_repository(project, linkproject):
@@ -128,7 +250,10 @@ def upload_meta_enable_repository(project, linkproject):
 
 def freeze_project(project):
     """Generate a _frozenlink file for the project"""
-    result = sh.osc('api', '-X', 'POST', '/source/%s?cmd=freezelink' % project)
+    import osc.core
+    result = osc.core.http_POST(
+        osc_api_url('source', project, cmd='freezelink')).read().decode(
+            'UTF-8')
     if '<status code="ok" />' not in result:
         print('WARNING: freeze the project fails: %s' % result)
 
@@ -166,8 +291,14 @@ def generate_pkgspec(pkgoutdir, spectemplate, pkgname):
 
         # configure a download cache to avoid downloading the same files
         download_env = os.environ.copy()
-        download_env["CACHEDIRECTORY"] = os.path.join(
-            os.path.expanduser("~"), ".cache", "download_files")
+        if DownloadCache:
+            download_cache = DownloadCache()
+            download_env["CACHEDIRECTORY"] = download_cache.download_dir
+            # sources moved to a new URL are served from the cache
+            download_cache.prepare(spec_source_urls(pkgname + '.spec'))
+        else:
+            download_env["CACHEDIRECTORY"] = os.path.join(
+                os.path.expanduser("~"), ".cache", "download_files")
 
         download_files = Command(os.path.join(obsservicedir, 'download_files'))
         download_files(_env=download_env, *outdir)
@@ -184,19 +315,47 @@ def osc_mkpac(workdir, packagename):
         os.chdir(olddir)
 
 
-def spec_is_modified(pkgoutdir, project, pkgname):
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def get_spec_md5s(project, pkgnames, jobs=4):
+    """
+    Get the md5 checksums of the spec files of several packages in the build
+    service, from their (expanded) source directory listings, which are
+    retrieved concurrently.
+
+    :return: dict mapping package names to spec file md5 checksums (None if
+    the package has no spec file)
+    """
+    import osc.core
+
+    def get_spec_md5(pkgname):
+        try:
+            listing = osc.core.http_GET(
+                osc_api_url('source', project, pkgname, expand=1)).read()
+        except osc.core.HTTPError:
+            return None
+        for entry in ET.fromstring(listing).findall('entry'):
+            if entry.get('name') == pkgname + '.spec':
+                return entry.get('md5')
+        return None
+
+    pool = ThreadPool(max(jobs, 1))
+    try:
+        return dict(zip(pkgnames, pool.map(get_spec_md5, pkgnames)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def spec_is_modified(pkgoutdir, pkgname, spec_md5):
     specname = pkgname + ".spec"
-    cached_spec = os.path.join(pkgoutdir, '.osc', specname)
-    cleanup = False
-    if not os.path.exists(cached_spec):
-        cleanup = True
-        sh.osc('api', '/source/%s/%s/%s.spec' % (
-            project, pkgname, pkgname), _out=cached_spec)
-    r = sh.cmp(
-        '-s', os.path.join(pkgoutdir, specname), cached_spec, _ok_code=[0, 1])
-    if cleanup:
-        os.remove(cached_spec)
-    return r.exit_code == 1
+    return file_md5(os.path.join(pkgoutdir, specname)) != spec_md5
 
 
 def osc_detachbranch(workdir, project, pkgname):
@@ -222,66 +381,236 @@ def osc_detachbranch(workdir, project, pkgname):
 
 
 def osc_commit_all(workdir, packagename):
-    olddir = os.getcwd()
-    try:
-        os.chdir(os.path.join(workdir, packagename))
-        sh.osc('addremove')
-        for o in sh.osc('service', 'localrun', 'source_validator'):
-            if o.startswith('###ASK'):
-                sh.osc('rm', '--force', o.strip().split()[1])
-        sh.osc('commit', '--noservice', '-n')
-    finally:
-        os.chdir(olddir)
+    # the working directory is passed explicitly, because packages are
+    # committed concurrently
+    pkgdir = os.path.join(workdir, packagename)
+    sh.osc('addremove', _cwd=pkgdir)
+    for o in sh.osc('service', 'localrun', 'source_validator', _cwd=pkgdir):
+        if o.startswith('###ASK'):
+            sh.osc('rm', '--force', o.strip().split()[1], _cwd=pkgdir)
+    sh.osc('commit', '--noservice', '-n', _cwd=pkgdir)
+
+
+def extra_sources(specdir):
+    return [f for f in sorted(glob.glob(os.path.join(specdir, '*')))
+            if not f.endswith(".j2")]
 
 
 def copy_extra_sources(specdir, pkgoutdir):
-    for f in glob.glob(os.path.join(specdir, '*')):
-        if f.endswith(".j2"):
-            continue
+    for f in extra_sources(specdir):
         shutil.copy2(f, pkgoutdir)
 
 
-def create_project(worktree, project, linkproject):
+# State of the last run, for each project, used in incremental mode
+INCREMENTAL_STATE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "createproject")
+
+
+def package_input_hash(spectemplate):
+    """Hash the inputs of a package: its spec template and extra sources"""
+    sha = hashlib.sha256()
+    for f in [spectemplate] + extra_sources(os.path.dirname(spectemplate)):
+        if not os.path.isfile(f):
+            continue
+        sha.update(os.path.basename(f).encode('UTF-8') + b'\0')
+        with open(f, 'rb') as source:
+            sha.update(source.read())
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+def incremental_state_path(project):
+    return os.path.join(INCREMENTAL_STATE_DIR, '%s.json' % project)
+
+
+def load_incremental_state(project):
+    try:
+        with open(incremental_state_path(project)) as state_file:
+            return json.load(state_file)
+    except (IOError, OSError, ValueError):
+        return {'commit': None, 'packages': {}}
+
+
+def save_incremental_state(project, state):
+    path = incremental_state_path(project)
+    if not os.path.isdir(INCREMENTAL_STATE_DIR):
+        os.makedirs(INCREMENTAL_STATE_DIR)
+    with open(path + '.tmp', 'w') as state_file:
+        json.dump(state, state_file, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+def worktree_commit(worktree):
+    try:
+        return str(sh.git('rev-parse', 'HEAD', _cwd=worktree)).strip()
+    except (sh.ErrorReturnCode, sh.CommandNotFound):
+        return None
+
+
+def worktree_changed_dirs(worktree, commit):
+    """
+    Get the spec template directories (relative to the worktree) with
+    changes since a given commit, including uncommitted changes.
+
+    :return: set of directories, or None if they cannot be determined
+    """
+    if not commit:
+        return None
+    try:
+        changed = str(sh.git('diff', '--name-only', commit, '--',
+                             'openstack', _cwd=worktree)).split()
+        changed += str(sh.git('ls-files', '--others', '--exclude-standard',
+                              '--', 'openstack', _cwd=worktree)).split()
+    except (sh.ErrorReturnCode, sh.CommandNotFound):
+        return None
+    return set(os.path.dirname(f) for f in changed)
+
+
+def render_package(args):
+    """Copy the sources and render the spec file for a package"""
+    spectemplate, pkgoutdir, pkgname = args
+    copy_extra_sources(os.path.dirname(spectemplate), pkgoutdir)
+    generate_pkgspec(pkgoutdir, spectemplate, pkgname)
+
+
+def report_stage(stage, count, start):
+    duration = time.time() - start
+    print("Stage %s: %d packages in %.1fs (%.2f packages/s)" % (
+        stage, count, duration, count / duration if duration else 0))
+    sys.stdout.flush()
+
+
+def create_project(worktree, project, linkproject, jobs=None, obs_jobs=4,
+                   incremental=False):
+    """
+    Create or update the packages in a build project, in stages:
+
+    * the packages are added to the local project checkout (serially)
+    * the package sources and spec files are rendered (concurrently, in a
+      pool of jobs processes)
+    * the checksums of the rendered spec files are compared to those of the
+      existing ones, which are retrieved concurrently, and the modified
+      packages are checked out (serially)
+    * the new and modified packages are committed (concurrently, by at most
+      obs_jobs threads)
+
+    Packages are always processed in the same, sorted, order.
+
+    In incremental mode, only the packages whose inputs (spec template and
+    extra sources) changed since the last incremental run for the same
+    project, as well as packages missing from the build service, are
+    processed. The worktree commit processed by the last run is used to
+    narrow down the set of packages to hash.
+    """
     workdir = os.path.join(os.getcwd(), 'out')
     sh.rm('-rf', workdir)
     create_new_build_project(workdir, project, linkproject)
+    import osc.core
     try:
-        existing_pkgs = [x.strip() for x in
-                         sh.osc('ls', '-e', project, _iter=True)]
+        existing_pkgs = osc.core.meta_get_packagelist(
+            get_osc_apiurl(), project, expand=True)
     except Exception:
         existing_pkgs = []
 
-    alive_pkgs = set()
     worktree_pattern = os.path.join(worktree, 'openstack', '*', '*.spec.j2')
 
-    for spectemplate in sorted(glob.glob(worktree_pattern)):
-        pkgname = pymodule2pkg(spectemplate)
+    if incremental:
+        state = load_incremental_state(project)
+        changed_dirs = worktree_changed_dirs(worktree, state['commit'])
+        new_state = {'commit': worktree_commit(worktree), 'packages': {}}
+
+    start = time.time()
+    packages = []
+    alive_pkgs = set()
+    spectemplates = sorted(glob.glob(worktree_pattern))
+    pkgnames = pymodules2pkgs(spectemplates)
+    for spectemplate in spectemplates:
+        pkgname = pkgnames[spectemplate]
         alive_pkgs.add(pkgname)
+        if incremental:
+            specdir = os.path.relpath(os.path.dirname(spectemplate),
+                                      worktree)
+            input_hash = state['packages'].get(pkgname)
+            if changed_dirs is None or specdir in changed_dirs or \
+                    not input_hash:
+                input_hash = package_input_hash(spectemplate)
+            new_state['packages'][pkgname] = input_hash
+            if input_hash == state['packages'].get(pkgname) and \
+                    pkgname in existing_pkgs:
+                continue
         print(pkgname)
         sys.stdout.flush()
 
         pkgoutdir = os.path.join(workdir, pkgname)
         osc_mkpac(workdir, pkgname)
-        copy_extra_sources(os.path.dirname(spectemplate), pkgoutdir)
-        generate_pkgspec(
-            pkgoutdir,
-            spectemplate, pkgname)
-
+        packages.append((spectemplate, pkgoutdir, pkgname))
+    if incremental:
+        print("Skipping %d unchanged packages" % (
+            len(alive_pkgs) - len(packages)))
+    report_stage('mkpac', len(packages), start)
+
+    start = time.time()
+    pool = multiprocessing.Pool(jobs)
+    try:
+        if DownloadCache:
+            with DownloadCache().downloading():
+                pool.map(render_package, packages, chunksize=1)
+        else:
+            pool.map(render_package, packages, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    if DownloadCache:
+        DownloadCache().update(
+            [f for _, pkgoutdir, _ in packages
+             for f in glob.glob(os.path.join(pkgoutdir, '*'))])
+    report_stage('render', len(packages), start)
+
+    start = time.time()
+    spec_md5s = get_spec_md5s(
+        project, [pkgname for _, _, pkgname in packages
+                  if pkgname in existing_pkgs], obs_jobs)
+    commit_pkgs = []
+    for _, pkgoutdir, pkgname in packages:
         if pkgname in existing_pkgs:
-            if spec_is_modified(pkgoutdir, project, pkgname):
+            if spec_is_modified(pkgoutdir, pkgname, spec_md5s[pkgname]):
                 osc_detachbranch(workdir, project, pkgname)
-
-                print("Committing update to %s" % pkgname)
+                commit_pkgs.append((pkgname, False))
+        else:
+            commit_pkgs.append((pkgname, True))
+    report_stage('diff', len(packages), start)
+
+    # committing a new package also updates the project checkout metadata,
+    # so new packages are committed one at a time
+    new_pkg_lock = threading.Lock()
+
+    def commit_package(commit_pkg):
+        pkgname, new = commit_pkg
+        if new:
+            with new_pkg_lock:
+                print("Adding new pkg %s" % pkgname)
                 osc_commit_all(workdir, pkgname)
         else:
-            print("Adding new pkg %s" % pkgname)
+            print("Committing update to %s" % pkgname)
             osc_commit_all(workdir, pkgname)
 
+    start = time.time()
+    commit_pool = ThreadPool(max(obs_jobs, 1))
+    try:
+        commit_pool.map(commit_package, commit_pkgs, chunksize=1)
+    finally:
+        commit_pool.close()
+        commit_pool.join()
+    report_stage('commit', len(commit_pkgs), start)
+
     # remove no longer alive pkgs
     for i in existing_pkgs:
         if not linkproject and i not in alive_pkgs:
             print("Removing outdated ", i)
-            sh.osc('rdelete', '-m', 'x', project, i)
+            osc.core.delete_package(get_osc_apiurl(), project, i, msg='x')
+
+    if incremental:
+        save_incremental_state(project, new_state)
 
 
 def main():
@@ -293,11 +622,22 @@ def main():
                         help='name of the destination buildservice project')
     parser.add_argument('--linkproject',
                         help='create project link to given project')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of packages rendered concurrently '
+                             '(defaults to the number of CPUs)')
+    parser.add_argument('--obs-jobs', type=int, default=4,
+                        help='number of packages committed to the build '
+                             'service concurrently')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only process packages whose inputs changed '
+                             'since the last incremental run for the same '
+                             'project')
 
     args = parser.parse_args()
 
     sh.ErrorReturnCode.truncate_cap = 9000
-    create_project(args.worktree, args.project, args.linkproject)
+    create_project(args.worktree, args.project, args.linkproject,
+                   args.jobs, args.obs_jobs, args.incremental)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+#
+# (c) Copyright 2019 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+"""
+Benchmark for the generate_heat_model ansible module.
+
+Generates a large synthetic input model and measures the time spent and the
+memory allocated by each of the module processing stages (enhance, generate
+and update). The results can be compared against the same module taken from
+another git revision, which is also used to check that both versions produce
+identical results, e.g.:
+
+    ./benchmark_heat_model.py --servers 2000 --baseline HEAD~1
+
+Keys whose values are expected to differ between the two revisions (e.g.
+because of an intentional change in the output) can be left out of the
+comparison, e.g.:
+
+    ./benchmark_heat_model.py --baseline HEAD~1 --ignore-key allocation_pools
+
+When several model sizes are supplied, the benchmark also reports how each
+stage scales with the number of servers, e.g.:
+
+    ./benchmark_heat_model.py --servers 500 1000 2000 4000
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+import types
+from copy import deepcopy
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2
+    tracemalloc = None
+
+LIBRARY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'library')
+MODULE_PATH = os.path.join(LIBRARY_DIR, 'generate_heat_model.py')
+
+sys.path.append(LIBRARY_DIR)
+
+import generate_heat_model  # noqa: E402
+
+STAGES = ['enhance', 'generate', 'update']
+
+
+def load_baseline_module(revision):
+    """
+    Load the generate_heat_model module from a git revision.
+    """
+    git_root = subprocess.check_output(
+        ['git', 'rev-parse', '--show-toplevel'],
+        cwd=LIBRARY_DIR).decode('utf-8').strip()
+    source = subprocess.check_output(
+        ['git', 'show', '{}:{}'.format(
+            revision, os.path.relpath(MODULE_PATH, git_root))],
+        cwd=git_root).decode('utf-8')
+    module = types.ModuleType('generate_heat_model_{}'.format(revision))
+    module.__file__ = MODULE_PATH
+    exec(compile(source, MODULE_PATH, 'exec'), module.__dict__)
+    return module
+
+
+def synthetic_input_model(servers, control_planes=3, network_groups=12):
+    """
+    Generate an input model with the given number of servers, spread across
+    the given number of control planes. Each control plane has three
+    controllers, the remaining servers are compute nodes.
+    """
+    model = dict(
+        cloud=dict(name='benchmark'),
+        baremetal=dict(subnet='172.16.0.0', netmask='255.255.0.0'),
+    )
+
+    group_names = ['MANAGEMENT', 'EXTERNAL-API', 'NEUTRON-VLAN'] + \
+        ['NETGROUP-{}'.format(idx) for idx in range(network_groups - 3)]
+    model['network-groups'] = [
+        dict(name='MANAGEMENT', hostname_suffix='mgmt',
+             **{'component-endpoints': ['default', 'lifecycle-manager'],
+                'routes': ['default'],
+                'load-balancers': ['lb-{}'.format(cp)
+                                   for cp in range(control_planes)]}),
+        dict(name='EXTERNAL-API',
+             **{'routes': ['default', 'MANAGEMENT'],
+                'load-balancers': ['extapi-{}'.format(cp)
+                                   for cp in range(control_planes)]}),
+        dict(name='NEUTRON-VLAN',
+             tags=[{'neutron.networks.vlan': {
+                 'provider-physical-network': 'physnet1'}}],
+             routes=['ext-net']),
+    ] + [dict(name=name, routes=['MANAGEMENT'])
+         for name in group_names[3:]]
+
+    model['networks'] = [
+        dict(name='{}-NET'.format(name), vlanid=100 + idx,
+             cidr='10.{}.0.0/16'.format(idx),
+             **{'tagged-vlan': idx != 0,
+                'gateway-ip': '10.{}.0.1'.format(idx),
+                'network-group': name})
+        for idx, name in enumerate(group_names)]
+    model['networks'][0]['cidr'] = '172.16.0.0/16'
+    model['networks'][0]['gateway-ip'] = '172.16.0.1'
+
+    model['configuration-data'] = [
+        dict(name='NEUTRON-CONFIG-CP{}'.format(cp), services=['neutron'],
+             data=dict(
+                 neutron_external_networks=[
+                     dict(name='ext-net', cidr='172.31.0.0/16',
+                          gateway='172.31.0.1')],
+                 neutron_provider_networks=[
+                     dict(name='PROVIDER-NET', cidr='172.30.0.0/16',
+                          provider=[dict(network_type='vlan',
+                                         physical_network='physnet1',
+                                         segmentation_id=106)])]),
+             **{'network-tags': [
+                 {'network-group': 'MANAGEMENT',
+                  'tags': ['neutron.l3_agent.external_network_bridge']}]})
+        for cp in range(control_planes)] + [
+        dict(name='SWIFT-CONFIG-CP{}'.format(cp), services=['swift'],
+             data=dict())
+        for cp in range(control_planes)]
+
+    model['disk-models'] = [
+        dict(name='{}-DISKS'.format(role),
+             **{'volume-groups': [
+                 {'name': 'ardana-vg',
+                  'physical-volumes': ['/dev/sda_root', '/dev/sdb']}],
+                'device-groups': [
+                    {'name': 'swift',
+                     'devices': [{'name': '/dev/sdc'},
+                                 {'name': '/dev/sdd'}]}]})
+        for role in ['CONTROLLER', 'COMPUTE', 'UNUSED']]
+
+    model['interface-models'] = [
+        dict(name='{}-INTERFACES'.format(role),
+             **{'network-interfaces': [
+                 dict(name='BOND0', device=dict(name='bond0'),
+                      **{'bond-data': {
+                          'options': {'primary': 'hed1'},
+                          'devices': [dict(name='hed1'),
+                                      dict(name='hed2')]},
+                         'network-groups': group_names[:2]}),
+                 dict(name='ETH3', device=dict(name='hed3'),
+                      **{'network-groups': group_names[3:],
+                         'forced-network-groups': ['NEUTRON-VLAN']})]})
+        for role in ['CONTROLLER', 'COMPUTE', 'UNUSED']]
+
+    model['server-roles'] = [
+        dict(name='{}-ROLE'.format(role),
+             **{'interface-model': '{}-INTERFACES'.format(role),
+                'disk-model': '{}-DISKS'.format(role)})
+        for role in ['CONTROLLER', 'COMPUTE', 'UNUSED']]
+
+    model['control-planes'] = [
+        dict(name='cp{}'.format(cp),
+             **{'configuration-data': ['NEUTRON-CONFIG-CP{}'.format(cp),
+                                       'SWIFT-CONFIG-CP{}'.format(cp)],
+                'clusters': [
+                    {'name': 'cluster{}'.format(cp),
+                     'server-role': 'CONTROLLER-ROLE',
+                     'service-components': [
+                         'lifecycle-manager', 'nova-api',
+                         'neutron-server', 'keystone-api']}],
+                'resources': [
+                    {'name': 'compute{}'.format(cp),
+                     'server-role': ['COMPUTE-ROLE'],
+                     'configuration-data': 'NEUTRON-CONFIG-CP{}'.format(cp),
+                     'service-components': ['nova-compute',
+                                            'neutron-openvswitch-agent']}],
+                'load-balancers': [
+                    {'name': 'lb-{}'.format(cp), 'roles': ['internal']},
+                    {'name': 'extapi-{}'.format(cp), 'roles': ['public']}]})
+        for cp in range(control_planes)]
+
+    model['server-groups'] = [
+        dict(name='RACK{}'.format(cp),
+             networks=['{}-NET'.format(name) for name in group_names])
+        for cp in range(control_planes)] + [
+        dict(name='CLOUD',
+             **{'server-groups': ['RACK{}'.format(cp)
+                                  for cp in range(control_planes)]})]
+
+    model['nic-mappings'] = [
+        {'name': 'HW-{}'.format(role),
+         'physical-ports': [
+             {'logical-name': 'hed{}'.format(port),
+              'type': 'simple-port',
+              'bus-address': '0000:07:00.{}'.format(port)}
+             for port in range(1, 4)]}
+        for role in ['CONTROLLER', 'COMPUTE', 'UNUSED']]
+
+    model['servers'] = []
+    for idx in range(servers):
+        role = 'CONTROLLER' if idx < 3 * control_planes else 'COMPUTE'
+        model['servers'].append({
+            'id': '{}{}'.format(role.lower(), idx),
+            'ip-addr': '172.16.{}.{}'.format(idx // 250 + 1, idx % 250 + 2),
+            'role': '{}-ROLE'.format(role),
+            'nic-mapping': 'HW-{}'.format(role),
+            'server-group': 'RACK{}'.format(idx % control_planes),
+            'mac-addr': '52:54:00:{:02x}:{:02x}:{:02x}'.format(
+                idx >> 16 & 0xff, idx >> 8 & 0xff, idx & 0xff),
+        })
+
+    model['firewall-rules'] = []
+
+    return model
+
+
+def synthetic_virt_config():
+    return dict(
+        sles_distro_id='sles12sp4-x86_64',
+        rhel_distro_id='rhel7-x86_64',
+        sles_image='sles12sp4',
+        rhel_image='centos7',
+        clm_flavor='cloud-ardana-job-compute',
+        controller_flavor='cloud-ardana-job-controller',
+        compute_flavor='cloud-ardana-job-compute',
+        clm_service_components=['lifecycle-manager'],
+        disk_size=2,
+        disks=dict(),
+        images=dict(),
+        flavors=dict(),
+    )
+
+
+def run_stages(module, input_model, virt_config):
+    """
+    Run the module processing stages in the same way the module does.
+
+    :return: the heat template, the updated input model and a dictionary
+    with the time (in seconds) spent in each stage
+    """
+    timings = dict()
+    start = time.time()
+    enhanced_input_model = module.enhance_input_model(input_model)
+    timings['enhance'] = time.time() - start
+    start = time.time()
+    heat_template = module.generate_heat_model(enhanced_input_model,
+                                               virt_config)
+    timings['generate'] = time.time() - start
+    start = time.time()
+    input_model = module.update_input_model(input_model, heat_template)
+    timings['update'] = time.time() - start
+    return heat_template, input_model, timings
+
+
+def measure(module, input_model, virt_config, repeat):
+    """
+    Measure the best time and the peak memory allocated by each stage.
+
+    :return: dictionary of (time, peak allocated bytes) tuples indexed by
+    stage, and the results of the last run
+    """
+    best = dict()
+    for _ in range(repeat):
+        # update_input_model modifies the input model in place
+        model = deepcopy(input_model)
+        results = run_stages(module, model, virt_config)
+        for stage in STAGES:
+            best[stage] = min(best.get(stage, results[2][stage]),
+                              results[2][stage])
+
+    peaks = dict.fromkeys(STAGES)
+    if tracemalloc:
+        model = deepcopy(input_model)
+        tracemalloc.start()
+        enhanced_input_model = module.enhance_input_model(model)
+        peaks['enhance'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        tracemalloc.start()
+        heat_template = module.generate_heat_model(enhanced_input_model,
+                                                   virt_config)
+        peaks['generate'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        tracemalloc.start()
+        module.update_input_model(model, heat_template)
+        peaks['update'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return dict([(stage, (best[stage], peaks[stage])) for stage in STAGES]), \
+        results[:2]
+
+
+def strip_keys(data, keys):
+    """
+    Remove dictionary keys from a data structure, at any depth.
+
+    :return: a copy of the data structure without the given keys
+    """
+    if isinstance(data, dict):
+        return dict([(key, strip_keys(value, keys))
+                     for key, value in data.items() if key not in keys])
+    if isinstance(data, (list, tuple)):
+        return [strip_keys(item, keys) for item in data]
+    return data
+
+
+def format_peak(peak):
+    if peak is None:
+        return 'n/a'
+    return '{:.1f}MiB'.format(peak / 1024.0 / 1024.0)
+
+
+def print_scaling(sizes, timings):
+    """
+    Print how the time spent by each stage grows with the number of servers,
+    as the exponent k of the best fitting time ~ servers^k curve between the
+    smallest and the largest model (1 means linear, 2 quadratic).
+    """
+    print('Scaling from {} to {} servers (time ~ servers^k):'.format(
+        sizes[0], sizes[-1]))
+    for name, stage_timings in timings:
+        print('{:<12} {}'.format(name, '  '.join(
+            '{}: k={:.2f}'.format(stage, math.log(
+                max(stage_timings[stage][-1], 1e-6) /
+                max(stage_timings[stage][0], 1e-6)) /
+                math.log(float(sizes[-1]) / sizes[0]))
+            for stage in STAGES)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the generate_heat_model module on a large '
+                    'synthetic input model')
+    parser.add_argument('--servers', type=int, nargs='+', default=[1000],
+                        help='number of servers in the input model. If '
+                             'several values are supplied, the benchmark '
+                             'is run for each of them and the scaling of '
+                             'each stage is also reported')
+    parser.add_argument('--control-planes', type=int, default=3,
+                        help='number of control planes in the input model')
+    parser.add_argument('--network-groups', type=int, default=12,
+                        help='number of network groups in the input model')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs (the best time is reported)')
+    parser.add_argument('--baseline', default=None,
+                        help='git revision of the module to compare against')
+    parser.add_argument('--ignore-key', action='append', default=[],
+                        help='leave a key out of the comparison with the '
+                             'baseline results (can be repeated)')
+    args = parser.parse_args()
+
+    virt_config = synthetic_virt_config()
+    if not tracemalloc:
+        print('tracemalloc is not available, skipping memory measurements')
+
+    modules = [('current', generate_heat_model)]
+    if args.baseline:
+        modules.insert(0, (args.baseline, load_baseline_module(args.baseline)))
+    sizes = sorted(args.servers)
+    timings = [(name, dict([(stage, []) for stage in STAGES]))
+               for name, _ in modules]
+
+    for servers in sizes:
+        input_model = synthetic_input_model(servers, args.control_planes,
+                                            args.network_groups)
+        print('{} servers, {} control planes, {} network groups'.format(
+            servers, args.control_planes, args.network_groups))
+        print('{:<12} {:<10} {:>10} {:>12}'.format('module', 'stage', 'time',
+                                                   'peak alloc'))
+        results = []
+        for (name, module), (_, stage_timings) in zip(modules, timings):
+            stats, result = measure(module, input_model, virt_config,
+                                    args.repeat)
+            results.append(result)
+            for stage in STAGES:
+                stage_timings[stage].append(stats[stage][0])
+                print('{:<12} {:<10} {:>9.3f}s {:>12}'.format(
+                    name, stage, stats[stage][0],
+                    format_peak(stats[stage][1])))
+
+        if len(results) > 1:
+            # The results are compared in their JSON form, which is also how
+            # ansible returns them
+            if json.dumps(strip_keys(results[0], args.ignore_key),
+                          sort_keys=True) != \
+                    json.dumps(strip_keys(results[1], args.ignore_key),
+                               sort_keys=True):
+                print('ERROR: the results differ from the baseline results')
+                sys.exit(1)
+            print('The results are identical to the baseline results')
+
+    if len(sizes) > 1:
+        print_scaling(sizes, timings)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,13 +14,14 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 #
-from collections import OrderedDict
-from copy import deepcopy
+from collections import OrderedDict, namedtuple
+from copy import copy
 from traceback import format_exc
 
 from ansible.module_utils.basic import AnsibleModule
 
-from netaddr import IPAddress, IPNetwork
+from netaddr import AddrFormatError, IPAddress, IPNetwork
+from netaddr.strategy import ipv4
 
 from six import itervalues, string_types
 from six.moves import filter
@@ -217,13 +218,104 @@ input_model_schema = {
 }
 
 
+"""
+The input model schema is compiled once into an immutable plan, which is
+what the input model processing functions actually walk through:
+
+  ElementPlan:
+    - name: <element list name>
+    - key: <name of attribute representing the key>
+    - foreign_keys: tuple of ForeignKeyPlan
+    - elements: tuple of ElementPlan describing the sub elements
+    - prune: True if the element is a root element targeted by foreign keys,
+      which means its un-referenced instances are removed
+
+  ForeignKeyPlan:
+    - attr: <foreign key attribute>
+    - is_list: True if the attribute data type is list, False if it is a
+      string
+    - targets: tuple of root element names to which the key points
+    - ref_attr: <name of the reverse reference attribute created in the target
+      element(s)>
+"""
+ElementPlan = namedtuple('ElementPlan',
+                         ['name', 'key', 'foreign_keys', 'elements', 'prune'])
+ForeignKeyPlan = namedtuple('ForeignKeyPlan',
+                            ['attr', 'is_list', 'targets', 'ref_attr'])
+
+
+def compile_schema(element_name, element_schema, prune=False):
+    """
+    Compile an input model element schema into an element plan.
+
+    :param element_name: element list name
+    :param element_schema: input model element schema
+    :param prune: prune un-referenced element instances
+    :return: ElementPlan
+    """
+    foreign_keys = tuple(
+        ForeignKeyPlan(
+            attr=attr_name,
+            is_list=foreign_key['type'] == list,
+            targets=tuple(foreign_key['target']),
+            ref_attr=foreign_key.get('reverse-ref-attr', element_name))
+        for attr_name, foreign_key in
+        element_schema.get('foreign-keys', {}).items())
+    elements = tuple(
+        compile_schema(sub_element_name, sub_element_schema)
+        for sub_element_name, sub_element_schema in
+        element_schema.get('elements', {}).items())
+    return ElementPlan(
+        name=element_name,
+        key=element_schema.get('key', 'name'),
+        foreign_keys=foreign_keys,
+        elements=elements,
+        prune=prune)
+
+
+def schema_foreign_key_targets(element_schema):
+    """
+    Collect the names of all root elements targeted by foreign keys in an
+    input model element schema and its sub element schemas.
+    """
+    targets = set()
+    for foreign_key in element_schema.get('foreign-keys', {}).values():
+        targets.update(foreign_key['target'])
+    for sub_element_schema in element_schema.get('elements', {}).values():
+        targets.update(schema_foreign_key_targets(sub_element_schema))
+    return targets
+
+
+def compile_input_model_schema(schema):
+    """
+    Compile the input model schema into the input model plan.
+
+    :param schema: input model schema
+    :return: ElementPlan describing the input model root
+    """
+    prune_targets = schema_foreign_key_targets(schema)
+    return ElementPlan(
+        name='input-model',
+        key='name',
+        foreign_keys=(),
+        elements=tuple(
+            compile_schema(element_name, element_schema,
+                           prune=element_name in prune_targets)
+            for element_name, element_schema in
+            schema['elements'].items()),
+        prune=False)
+
+
+input_model_plan = compile_input_model_schema(input_model_schema)
+
+
 # The number of addresses from the Ardana management subnet
 # that are set aside for external management services
 EXTERNAL_MGMT_ADDR_RANGE = 50
 
 
 def convert_element_list_to_map(element, list_attr_name,
-                                foreign_key_attr='name'):
+                                foreign_key_attr='name', copy_items=False):
     """
     Convert an attribute representing a list of elements into a dictionary
     indexed by the element's key.
@@ -255,39 +347,59 @@ def convert_element_list_to_map(element, list_attr_name,
     :param element: the element being modified
     :param list_attr_name: list attribute name
     :param foreign_key_attr: foreign key attribute name (default: 'name')
+    :param copy_items: map shallow copies of the list items instead of the
+    items themselves
     :return: the new dictionary attribute value
     """
     if list_attr_name in element:
         element[list_attr_name] = OrderedDict(
-            [(item[foreign_key_attr], item,)
+            [(item[foreign_key_attr], copy(item) if copy_items else item,)
              for item in element[list_attr_name]])
     else:
         element[list_attr_name] = OrderedDict()
     return element[list_attr_name]
 
 
-def map_list_attrs(element, element_schema):
+def index_elements(element, element_plan, element_index, parent_key=''):
     """
     Does a recursive walk through the supplied input model elements
-    and through the indicated input model schema, in parallel, and converts
-    attributes indicated by the schema as representing sub-element lists into
-    sub-element maps (dictionaries) indexed by their respective element key
-    values.
+    and through the indicated input model plan, in parallel, and builds
+    an overlay of the input model made of shallow element copies, where
+    attributes indicated by the plan as representing sub-element lists are
+    converted into sub-element maps (dictionaries) indexed by their respective
+    element key values. The supplied input model is not modified.
+
+    The sub-element maps with elements that have foreign keys are also
+    recorded in the element index, in the order in which the foreign keys
+    need to be resolved.
 
     :param element: input model element
-    :param element_schema: input model element schema
-    :return:
+    :param element_plan: input model element plan
+    :param element_index: list collecting (sub-element plan, parent element
+    key, sub-element map) tuples
+    :param parent_key: the key of the parent element - used to compute
+    relative keys
+    :return: the element copy
     """
-    schema_sub_elements = element_schema.get('elements', {})
-    for sub_element_name, sub_element_schema in schema_sub_elements.items():
-        input_model_subelements = element.get(sub_element_name, {})
-        if element.get(sub_element_name, None) is None:
+    element = copy(element)
+    element_key = element.get(element_plan.key)
+    if element_key and parent_key:
+        element_key = "-".join([parent_key, element_key])
+
+    for sub_element_plan in element_plan.elements:
+        if element.get(sub_element_plan.name, None) is None:
             continue
-        convert_element_list_to_map(
-            element, sub_element_name,
-            sub_element_schema.get('key', 'name'))
-        for input_model_element in input_model_subelements:
-            map_list_attrs(input_model_element, sub_element_schema)
+        sub_elements = convert_element_list_to_map(
+            element, sub_element_plan.name, sub_element_plan.key)
+        if sub_element_plan.foreign_keys:
+            element_index.append((sub_element_plan, element_key,
+                                  sub_elements,))
+        for sub_element_key in list(sub_elements):
+            sub_elements[sub_element_key] = index_elements(
+                sub_elements[sub_element_key], sub_element_plan,
+                element_index, element_key)
+
+    return element
 
 
 def link_elements(element, target_element,
@@ -328,82 +440,71 @@ def link_elements_by_foreign_key_list(element, foreign_key_list_attr,
                           ref_list_attr, element_key)
 
 
-def map_foreign_keys(root_element, element_name,
-                     element, element_schema, parent_key=''):
+def map_foreign_keys(root_element, element_index):
     """
-    Does a recursive walk through the supplied input model elements
-    and through the indicated input model schema, in parallel, and
-    replaces foreign keys with actual element references.
+    Replaces the foreign keys of the indexed input model elements with actual
+    element references.
+
+    Foreign key lists are replaced with copies before being updated, because
+    they are shared with the original input model.
 
     :param root_element: input model root - used to resolve foreign key
     targets
-    :param element_name: name of the current input model element
-    :param element: input current model element
-    :param element_schema: input model element schema
-    :param parent_key: the key of the parent element - used to compute
-    relative keys
-    :return:
+    :param element_index: element index built by index_elements
+    :return: the set of root elements targeted by foreign keys, which need
+    pruning
     """
-    foreign_keys = element_schema.get('foreign-keys', {})
-    schema_sub_elements = element_schema.get('elements', {})
-    element_key_attr = element_schema.get('key', 'name')
-    element_key = element.get(element_key_attr)
-    if element_key and parent_key:
-        element_key = "-".join([parent_key, element_key])
+    prune_targets = set()
+    for element_plan, parent_key, elements in element_index:
+        for element in itervalues(elements):
+            element_key = element.get(element_plan.key)
+            if element_key and parent_key:
+                element_key = "-".join([parent_key, element_key])
+
+            for foreign_key in element_plan.foreign_keys:
+                if foreign_key.is_list:
+                    value = element.get(foreign_key.attr)
+                    if isinstance(value, string_types):
+                        element[foreign_key.attr] = [value]
+                    elif isinstance(value, list):
+                        element[foreign_key.attr] = list(value)
+
+                for target in foreign_key.targets:
+                    prune_targets.add(target)
+                    if foreign_key.is_list:
+                        link_elements_by_foreign_key_list(
+                            element, foreign_key.attr,
+                            root_element[target],
+                            foreign_key.ref_attr,
+                            element_key)
+                    else:
+                        link_elements_by_foreign_key(
+                            element, foreign_key.attr,
+                            root_element[target],
+                            foreign_key.ref_attr,
+                            element_key)
 
-    for attr_name, foreign_key in foreign_keys.items():
-        for target in foreign_key['target']:
-            ref_list_attr_name = foreign_key.get(
-                'reverse-ref-attr',
-                element_name)
-            # Mark the foreign element in the schema as needing pruning
-            input_model_schema['elements'][target]['prune'] = True
-            if foreign_key['type'] == list:
-
-                if isinstance(element.get(attr_name), string_types):
-                    element[attr_name] = [element[attr_name]]
-                link_elements_by_foreign_key_list(
-                    element, attr_name,
-                    root_element[target],
-                    ref_list_attr_name,
-                    element_key)
-
-            elif foreign_key['type'] == string_types:
-                link_elements_by_foreign_key(
-                    element, attr_name,
-                    root_element[target],
-                    ref_list_attr_name,
-                    element_key)
-
-    for sub_element_name, sub_element_schema in schema_sub_elements.items():
-        if element.get(sub_element_name, None) is None:
-            continue
-        for input_model_element in element[sub_element_name].values():
-            map_foreign_keys(
-                root_element, sub_element_name,
-                input_model_element, sub_element_schema, element_key)
+    return prune_targets
 
 
-def prune_input_model(element, element_schema):
+def prune_input_model(input_model, prune_targets):
     """
-    Does a recursive walk through the supplied input model elements
-    and through the indicated input model schema, in parallel, and
-    removes un-referenced elements from the input model.
+    Removes un-referenced elements from the input model root elements
+    targeted by foreign keys.
 
-    :param element: input model element
-    :param element_schema: input model element schema
+    :param input_model: input model root
+    :param prune_targets: names of the root elements that were targeted
+    while resolving foreign keys
     :return:
     """
-    schema_sub_elements = element_schema.get('elements', {})
-    for sub_element_name, sub_element_schema in schema_sub_elements.items():
-        if element.get(sub_element_name, None) is None:
+    for element_plan in input_model_plan.elements:
+        if not element_plan.prune or \
+                element_plan.name not in prune_targets or \
+                input_model.get(element_plan.name, None) is None:
             continue
-        if sub_element_schema.get('prune'):
-            element[sub_element_name] = dict(filter(
-                lambda el_rec: el_rec[1].get('is-referenced'),
-                element[sub_element_name].items()))
-        for input_model_element in element[sub_element_name].values():
-            prune_input_model(input_model_element, sub_element_schema)
+        input_model[element_plan.name] = dict(filter(
+            lambda el_rec: el_rec[1].get('is-referenced'),
+            input_model[element_plan.name].items()))
 
 
 def enhance_input_model(input_model):
@@ -421,19 +522,24 @@ def enhance_input_model(input_model):
     extends the input model data structure with information pertaining to
     identified neutron networks.
 
-    :param input_model: original input model, as loaded from disk
+    :param input_model: original input model, as loaded from disk (left
+    unmodified)
     :return: enhanced input model data structure
     """
 
-    input_model = deepcopy(input_model)
-
-    map_list_attrs(input_model, input_model_schema)
+    # The enhanced input model is an overlay of the original input model,
+    # which update_input_model still needs: all elements described by the
+    # schema are shallow-copied, while other values (and the neutron
+    # configuration data, below) are only copied before being modified.
+    # Input model elements are mostly flat, so this takes as much memory
+    # as a deep copy would.
+    element_index = []
+    input_model = index_elements(
+        input_model, input_model_plan, element_index)
 
-    map_foreign_keys(
-        input_model, 'input-model',
-        input_model, input_model_schema)
+    prune_targets = map_foreign_keys(input_model, element_index)
 
-    prune_input_model(input_model, input_model_schema)
+    prune_input_model(input_model, prune_targets)
 
     # Assume there is at most one neutron configuration data
     neutron_config_data = list(filter(
@@ -472,12 +578,16 @@ def enhance_input_model(input_model):
                 network_tag['network-group'],
                 network_tag['tags'])
 
+        neutron_data = neutron_config_data['data'] = \
+            copy(neutron_config_data['data'])
         external_networks = convert_element_list_to_map(
-            neutron_config_data['data'],
-            'neutron_external_networks')
+            neutron_data,
+            'neutron_external_networks',
+            copy_items=True)
         provider_networks = convert_element_list_to_map(
-            neutron_config_data['data'],
-            'neutron_provider_networks')
+            neutron_data,
+            'neutron_provider_networks',
+            copy_items=True)
         neutron_networks.update(external_networks)
         neutron_networks.update(provider_networks)
         for network in itervalues(external_networks):
@@ -485,29 +595,43 @@ def enhance_input_model(input_model):
         for network in itervalues(provider_networks):
             network['external'] = False
 
+    # Index everything network groups may reference by name, so that all
+    # network group references can be resolved in a single pass:
+    #   - route targets: network groups and neutron networks, network groups
+    #   taking precedence when names collide
+    #   - control plane load balancers: the first control plane defining a
+    #   load balancer name owns it
+    route_targets = dict(neutron_networks)
+    route_targets.update(input_model['network-groups'])
+    cp_load_balancers = [cp['load-balancers'] for cp in
+                         itervalues(input_model['control-planes'])
+                         if cp.get('load-balancers', None) is not None]
+    load_balancers = dict()
+    for cp_load_balancer_map in reversed(cp_load_balancers):
+        load_balancers.update(cp_load_balancer_map)
+
     for network_group in itervalues(input_model['network-groups']):
         if neutron_config_data and 'tags' in network_group:
             add_neutron_network_tags(
                 network_group['name'],
                 network_group['tags'])
+
+        # Route and load balancer references are replaced in place
+        network_group['routes'] = list(network_group.get('routes', []))
         link_elements_by_foreign_key_list(
             network_group, 'routes',
-            input_model['network-groups'],
-            ref_list_attr='network-group-routes')
-        link_elements_by_foreign_key_list(
-            network_group, 'routes',
-            neutron_networks,
+            route_targets,
             ref_list_attr='network-group-routes')
 
         # Network groups may contain references to control plane load
         # balancers, which we have to transform into object references
         # explicitly here
-        for cp in input_model['control-planes'].values():
-            if cp.get('load-balancers', None) is None:
-                continue
+        if cp_load_balancers:
+            network_group['load-balancers'] = \
+                list(network_group.get('load-balancers', []))
             link_elements_by_foreign_key_list(
                 network_group, 'load-balancers',
-                cp['load-balancers'],
+                load_balancers,
                 ref_list_attr=None)
 
     # Based on the collected neutron networks and network tags, identify
@@ -559,6 +683,61 @@ def enhance_input_model(input_model):
     return input_model
 
 
+def ip_address_value(address):
+    """
+    Convert an IP address string to its integer value, without going through
+    an IPAddress object for the common case of IPv4 addresses.
+
+    :param address: IP address string
+    :return: integer IP address value
+    """
+    try:
+        return ipv4.str_to_int(address)
+    except AddrFormatError:
+        return int(IPAddress(address))
+
+
+def allocation_pools(first, last, reserved=()):
+    """
+    Compute the maximal ranges of free addresses in an address range, given
+    a set of reserved addresses, with a single sweep through the sorted
+    reserved addresses.
+
+    :param first: first address in the range (integer value)
+    :param last: last address in the range (integer value)
+    :param reserved: reserved addresses (integer values). Addresses outside
+    of the range are ignored
+    :return: list of [first, last] integer address pairs delimiting the free
+    address ranges, in ascending order
+    """
+    pools = []
+    start = first
+    for address in sorted(set(reserved)):
+        if address < start:
+            continue
+        if address > last:
+            break
+        if address > start:
+            pools.append([start, address - 1])
+        start = address + 1
+    if start <= last:
+        pools.append([start, last])
+    return pools
+
+
+def format_allocation_pools(pools, version=4):
+    """
+    Convert allocation pools computed by allocation_pools into IP address
+    strings.
+
+    :param pools: list of [first, last] integer address pairs
+    :param version: IP version
+    :return: list of [first, last] IP address string pairs
+    """
+    return [[str(IPAddress(start, version)), str(IPAddress(end, version))]
+            for start, end in pools]
+
+
 def generate_heat_model(input_model, virt_config):
     """
     Create a data structure that more or less describes the heat resources
@@ -678,23 +857,16 @@ def generate_heat_model(input_model, virt_config):
             clm_network = heat_network
             heat_network['external'] = heat_network['is_conf'] = True
 
-            # Create an address pool range that excludes the list of server
-            # static IP addresses
-            fixed_ip_addr_list = \
-                [IPAddress(server['ip-addr'])
-                 for server in itervalues(input_model['servers'])]
+            # Create address pool ranges that cover all the addresses in the
+            # subnet, except for the server static IP addresses and the
+            # gateway
+            reserved = [ip_address_value(server['ip-addr'])
+                        for server in itervalues(input_model['servers'])]
             if gateway:
-                fixed_ip_addr_list.append(gateway)
-            start_addr = cidr[1]
-            end_addr = cidr[-2]
-            for fixed_ip_addr in sorted(list(set(fixed_ip_addr_list))):
-                if start_addr <= fixed_ip_addr <= end_addr:
-                    if fixed_ip_addr - start_addr < end_addr - fixed_ip_addr:
-                        start_addr = fixed_ip_addr + 1
-                    else:
-                        end_addr = fixed_ip_addr - 1
-            heat_network['allocation_pools'] = \
-                [[str(start_addr), str(end_addr)]]
+                reserved.append(gateway.value)
+            heat_network['allocation_pools'] = format_allocation_pools(
+                allocation_pools(cidr.first + 1, cidr.last - 1, reserved),
+                cidr.version)
 
         elif ('component-endpoints' in network['network-group'] and 'default'
               in network['network-group']['component-endpoints']):
@@ -702,10 +874,13 @@ def generate_heat_model(input_model, virt_config):
 
             # Create an address pool range that is outside of the range
             # of IP addresses allocated by Ardana
-            mgmt_net_last = IPAddress(IPNetwork(network['cidr']).last)
-            heat_network['allocation_pools'] = \
-                [[str(mgmt_net_last - EXTERNAL_MGMT_ADDR_RANGE),
-                  str(mgmt_net_last - 1)]]
+            mgmt_cidr = IPNetwork(network['cidr'])
+            heat_network['allocation_pools'] = format_allocation_pools(
+                allocation_pools(
+                    mgmt_cidr.last - EXTERNAL_MGMT_ADDR_RANGE,
+                    mgmt_cidr.last - 1,
+                    [gateway.value] if gateway else []),
+                mgmt_cidr.version)
         elif True in [('public' in lb['roles'])
                       for lb in network['network-group'].get('load-balancers',
                                                              [])]:
@@ -938,15 +1113,24 @@ def update_input_model(input_model, heat_template):
     :param heat_template:
     :return:
     """
+    heat_servers = dict()
+    for heat_server in heat_template['servers']:
+        heat_servers.setdefault(heat_server['name'], heat_server)
+
     for server in input_model['servers']:
-        heat_server = list(filter(lambda s: server['id'] == s['name'],
-                                  heat_template['servers']))
+        heat_server = heat_servers.get(server['id'])
         if not heat_server:
             # Skip servers that have been filtered out
             # by the heat template generator
             continue
         server['nic-mapping'] = \
-            "HEAT-{}".format(heat_server[0]['interface_model'])
+            "HEAT-{}".format(heat_server['interface_model'])
+
+    # Index the NIC mappings by name, the first mapping with a given name
+    # being the one that gets overwritten
+    nic_mapping_idx = dict()
+    for idx, nic_mapping in enumerate(input_model['nic-mappings']):
+        nic_mapping_idx.setdefault(nic_mapping['name'], idx)
 
     for interface_model in itervalues(heat_template['interface_models']):
         mapping_name = "HEAT-{}".format(interface_model['name'])
@@ -963,12 +1147,11 @@ def update_input_model(input_model, heat_template):
             })
 
         # Overwrite the mapping, if it's already defined
-        existing_mapping = list(filter(lambda mapping:
-                                       mapping[1]['name'] == mapping_name,
-                                       enumerate(input_model['nic-mappings'])))
-        if existing_mapping:
-            input_model['nic-mappings'][existing_mapping[0][0]] = nic_mapping
+        if mapping_name in nic_mapping_idx:
+            input_model['nic-mappings'][nic_mapping_idx[mapping_name]] = \
+                nic_mapping
         else:
+            nic_mapping_idx[mapping_name] = len(input_model['nic-mappings'])
             input_model['nic-mappings'].append(nic_mapping)
 
     return input_model
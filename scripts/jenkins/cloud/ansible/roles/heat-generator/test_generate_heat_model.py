@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'library'))
+
+import generate_heat_model  # noqa: E402
+
+
+class TestAllocationPools(unittest.TestCase):
+
+    def test_no_reserved(self):
+        self.assertEqual(generate_heat_model.allocation_pools(10, 20),
+                         [[10, 20]])
+
+    def test_reserved(self):
+        self.assertEqual(
+            generate_heat_model.allocation_pools(10, 20, [15, 12, 15]),
+            [[10, 11], [13, 14], [16, 20]])
+
+    def test_reserved_bounds(self):
+        self.assertEqual(
+            generate_heat_model.allocation_pools(10, 20, [10, 20]),
+            [[11, 19]])
+
+    def test_reserved_outside_bounds(self):
+        self.assertEqual(
+            generate_heat_model.allocation_pools(10, 20, [1, 9, 21, 30]),
+            [[10, 20]])
+
+    def test_adjacent_reserved(self):
+        self.assertEqual(
+            generate_heat_model.allocation_pools(10, 20, [13, 14, 15]),
+            [[10, 12], [16, 20]])
+        self.assertEqual(
+            generate_heat_model.allocation_pools(10, 20, [10, 11, 19, 20]),
+            [[12, 18]])
+
+    def test_all_reserved(self):
+        self.assertEqual(
+            generate_heat_model.allocation_pools(10, 12, [10, 11, 12]), [])
+
+    def test_single_address(self):
+        self.assertEqual(generate_heat_model.allocation_pools(10, 10),
+                         [[10, 10]])
+        self.assertEqual(generate_heat_model.allocation_pools(10, 10, [10]),
+                         [])
+
+    def test_empty_range(self):
+        self.assertEqual(generate_heat_model.allocation_pools(20, 10), [])
+        self.assertEqual(generate_heat_model.allocation_pools(20, 10, [15]),
+                         [])
+
+    def test_format_allocation_pools(self):
+        self.assertEqual(
+            generate_heat_model.format_allocation_pools(
+                [[167772161, 167772170], [167772172, 167772172]]),
+            [['10.0.0.1', '10.0.0.10'], ['10.0.0.12', '10.0.0.12']])
+        self.assertEqual(
+            generate_heat_model.format_allocation_pools(
+                [[1, 0xffff]], version=6),
+            [['::1', '::ffff']])
+        self.assertEqual(generate_heat_model.format_allocation_pools([]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,7 @@ project.
 
 import argparse
 import contextlib
+import fcntl
 import glob
 import os
 import re
@@ -30,11 +31,34 @@ except ImportError:
 
 sys.path.append(os.path.dirname(__file__))
 
-from gerrit import GERRIT_URL, GerritApiCaller, GerritChange  # noqa: E402,I100
+from download_cache import DownloadCache, \
+    spec_source_urls  # noqa: E402,I100
+
+from gerrit import GERRIT_URL, GerritApiCaller, GerritChange, \
+    concurrent_map  # noqa: E402,I100
 
 from gerrit_settings import gerrit_project_map, \
     obs_project_settings  # noqa: E402,I100
 
+from obs_api import OBSApi  # noqa: E402,I100
+
+# Package workspaces are cloned using a persistent cache of bare git
+# repositories, shared by all builds running on the same host, as a source
+# of git objects
+GIT_CACHE = os.environ.get('GIT_CACHE', True) in ['true', '1', True]
+GIT_CACHE_DIR = os.environ.get(
+    'GIT_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'git-mirrors'))
+# Maximum size (in bytes) of the git cache. The least recently used
+# repositories are removed when the cache grows beyond this size.
+GIT_CACHE_SIZE = int(os.environ.get('GIT_CACHE_SIZE', 10 * 1024 ** 3))
+
+# Maximum time (in seconds) to wait for all the test packages to build
+OBS_BUILD_TIMEOUT = int(os.environ.get('OBS_BUILD_TIMEOUT', 6 * 3600))
+# Number of consecutive polls after which a package that is still missing
+# from the OBS build results is considered failed
+OBS_MISSING_POLLS = int(os.environ.get('OBS_MISSING_POLLS', 20))
+
 
 @contextlib.contextmanager
 def cd(dir):
@@ -51,12 +75,153 @@ def cleanup_path(path):
         shutil.rmtree(path)
 
 
+@contextlib.contextmanager
+def file_lock(path, shared=False, blocking=True):
+    """
+    Hold an advisory lock on a file, which is created if it doesn't exist.
+
+    Lock files may be removed by the exclusive lock holder. The lock is
+    acquired again if that happens while waiting for it.
+
+    :return: True if the lock was acquired, False if blocking is False and
+    the lock is held by someone else
+    """
+    flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    if not blocking:
+        flags |= fcntl.LOCK_NB
+    while True:
+        with open(path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, flags)
+            except IOError:
+                yield False
+                return
+            try:
+                if os.path.exists(path) and os.path.samestat(
+                        os.stat(path), os.fstat(lock_file.fileno())):
+                    yield True
+                    return
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def path_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            size += os.lstat(os.path.join(root, name)).st_size
+    return size
+
+
+class GitCache(object):
+    """
+    Persistent cache of bare git repositories, used as a local source of git
+    objects when cloning workspaces.
+
+    Only branches and tags are mirrored - Gerrit change refs are fetched
+    from Gerrit into the workspaces, as needed. Each cached repository is
+    guarded by a file lock, held exclusively while it is updated or removed,
+    and shared while it is used as a reference for cloning, so that several
+    builds can share the cache safely.
+    """
+
+    def __init__(self, cache_dir=GIT_CACHE_DIR, max_size=GIT_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Created concurrently
+                pass
+
+    def _repo_dir(self, url):
+        name = re.sub(r'[^\w.-]+', '_', url.split('://')[-1])
+        return os.path.join(self.cache_dir, '%s.git' % name)
+
+    def update(self, url):
+        """
+        Create or update the cached bare repository for a git URL.
+
+        :return: the path of the cached repository
+        """
+        repo_dir = self._repo_dir(url)
+        with file_lock(repo_dir + '.lock'):
+            if not os.path.exists(repo_dir):
+                print("Creating git cache for %s" % url)
+                sh.git('init', '--bare', '--quiet', repo_dir)
+            sh.git('fetch', '--prune', '--quiet', url,
+                   '+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*',
+                   _cwd=repo_dir)
+            # The modification time of the lock file tracks usage
+            os.utime(repo_dir + '.lock', None)
+        return repo_dir
+
+    def clone(self, url, dest):
+        """
+        Clone a git URL, using the cache as a source of git objects.
+
+        The cache is only used during the clone operation. The clone does not
+        depend on it afterwards.
+        """
+        while True:
+            repo_dir = self.update(url)
+            with file_lock(repo_dir + '.lock', shared=True):
+                # The repository may have been pruned by another build
+                # after it was updated, before the shared lock was acquired
+                if os.path.isdir(repo_dir):
+                    sh.git('clone', '--quiet', '--reference', repo_dir,
+                           '--dissociate', url, dest)
+                    return
+
+    @staticmethod
+    def _remove_stale_lock(repo_dir):
+        """
+        Remove the lock file left behind by a repository that no longer
+        exists, unless it is being used to create the repository again.
+        """
+        if os.path.exists(repo_dir):
+            return
+        with file_lock(repo_dir + '.lock', blocking=False) as locked:
+            if locked and not os.path.exists(repo_dir):
+                os.remove(repo_dir + '.lock')
+
+    def prune(self):
+        """
+        Remove the least recently used repositories until the cache size
+        drops below the configured limit. Repositories in use are skipped.
+        """
+        repos = []
+        for name in os.listdir(self.cache_dir):
+            repo_dir = os.path.join(self.cache_dir, name)
+            if name.endswith('.git.lock'):
+                self._remove_stale_lock(repo_dir[:-len('.lock')])
+            elif name.endswith('.git') and os.path.isdir(repo_dir):
+                lock_path = repo_dir + '.lock'
+                last_used = os.path.getmtime(lock_path) \
+                    if os.path.exists(lock_path) else 0
+                repos.append((last_used, repo_dir, path_size(repo_dir)))
+
+        cache_size = sum(size for _, _, size in repos)
+        for _, repo_dir, size in sorted(repos):
+            if cache_size <= self.max_size:
+                break
+            with file_lock(repo_dir + '.lock', blocking=False) as locked:
+                if not locked:
+                    continue
+                print("Removing %s from the git cache" % repo_dir)
+                shutil.rmtree(repo_dir)
+                os.remove(repo_dir + '.lock')
+                cache_size -= size
+
+
 class OBSPackage:
     """
     Manage the workspace of a package.
     """
 
-    def __init__(self, gerrit_project, url, target_branch, source_workspace):
+    def __init__(self, gerrit_project, url, target_branch, source_workspace,
+                 git_cache=None):
         self.gerrit_project = gerrit_project
         self.name = gerrit_project_map(target_branch)[gerrit_project]
         self.url = url
@@ -65,40 +230,48 @@ class OBSPackage:
         self.source_workspace = source_workspace
         self.source_dir = os.path.join(
             self.source_workspace, '%s.git' % self.gerrit_project)
+        self.git_cache = git_cache
         self._workspace_ready = False
         self._applied_changes = set()
+        self._queued_changes = []
 
     def prep_workspace(self):
 
         if self._workspace_ready:
             return
 
-        with cd(self.source_workspace):
-            if not os.path.exists('%s.git/.git' % self.gerrit_project):
-                print("Cloning gerrit project %s" % self.gerrit_project)
-                sh.git('clone', self.url, '%s.git' % self.gerrit_project)
-
-        with cd(self.source_dir):
-            # If another change is already checked out on this branch,
-            # don't clobber it. This shouldn't happen when building in a clean
-            # workspace so long as there is only one Package per
-            # gerrit_project.
-            try:
-                sh.git('checkout', self.test_branch)
-            except sh.ErrorReturnCode_1:
-                sh.git('checkout', '-b', self.test_branch,
-                       'origin/%s' % self.target_branch)
+        # NOTE: git commands are run with an explicit working directory
+        #       instead of changing the current directory, because workspaces
+        #       are prepared concurrently
+        if not os.path.exists(os.path.join(self.source_dir, '.git')):
+            print("Cloning gerrit project %s" % self.gerrit_project)
+            if self.git_cache:
+                self.git_cache.clone(self.url, self.source_dir)
+            else:
+                sh.git('clone', self.url, self.source_dir)
+
+        # If another change is already checked out on this branch,
+        # don't clobber it. This shouldn't happen when building in a clean
+        # workspace so long as there is only one Package per
+        # gerrit_project.
+        try:
+            sh.git('checkout', self.test_branch, _cwd=self.source_dir)
+        except sh.ErrorReturnCode_1:
+            sh.git('checkout', '-b', self.test_branch,
+                   'origin/%s' % self.target_branch, _cwd=self.source_dir)
 
         self._workspace_ready = True
 
-    def add_change(self, change):
+    def _check_change(self, change):
         """
-        Merge a given GerritChange into the git source_workspace if possible
+        Check if a given GerritChange needs to be merged into the package
+
+        :return: True if the change needs to be merged, False otherwise
         """
-        print("Attempting to add %s to %s" % (change, self))
-        if change in self._applied_changes:
+        if change in self._applied_changes or \
+                change in self._queued_changes:
             print("Change %s has already been applied" % change)
-            return
+            return False
         if change.branch != self.target_branch:
             raise Exception(
                 "Cannot merge change %s from branch %s onto target branch %s "
@@ -107,26 +280,51 @@ class OBSPackage:
         # Check change isn't already merged.
         if change.status == "MERGED":
             print("Change %s has already been merged in gerrit" % change)
-            return
+            return False
         elif change.status == "ABANDONED":
             raise Exception("Can not merge abandoned change %s" % change)
+        return True
+
+    def add_change(self, change):
+        """
+        Merge a given GerritChange into the git source_workspace if possible
+        """
+        print("Attempting to add %s to %s" % (change, self))
+        if not self._check_change(change):
+            return
 
         self.prep_workspace()
 
-        with cd(self.source_dir):
-            # If another change has already applied this change by having it as
-            # one of its ancestry commits then the following merge will do a
-            # harmless null operation
-            print("Fetching ref %s" % change.ref)
-            sh.git('fetch', self.url, change.ref)
-            sh.git('merge', '--no-edit', 'FETCH_HEAD')
-            self._applied_changes.add(change)
+        # If another change has already applied this change by having it as
+        # one of its ancestry commits then the following merge will do a
+        # harmless null operation
+        print("Fetching ref %s" % change.ref)
+        sh.git('fetch', self.url, change.ref, _cwd=self.source_dir)
+        sh.git('merge', '--no-edit', 'FETCH_HEAD', _cwd=self.source_dir)
+        self._applied_changes.add(change)
+
+    def queue_change(self, change):
+        """
+        Queue a given GerritChange to be merged into the git source_workspace
+        later on, by apply_queued_changes, if possible
+        """
+        print("Queueing %s for %s" % (change, self))
+        if self._check_change(change):
+            self._queued_changes.append(change)
+
+    def apply_queued_changes(self):
+        """
+        Merge the queued GerritChanges into the git source_workspace, in the
+        order in which they were queued
+        """
+        while self._queued_changes:
+            self.add_change(self._queued_changes.pop(0))
 
     def applied_change_numbers(self):
         return ", ".join([change.id for change in self._applied_changes])
 
     def has_applied_changes(self):
-        return bool(self._applied_changes)
+        return bool(self._applied_changes or self._queued_changes)
 
     def __repr__(self):
         return "<OBSPackage %s>" % self.name
@@ -140,13 +338,12 @@ def find_in_osc_file(description):
                       package=None, osc_data=None):
             if osc_data:
                 return find_func(project, osc_data)
-            osc_data = sh.osc(
-                '-A', 'https://api.suse.de', 'cat',
+            osc_data = project.obs_api.cat(
                 project.obs_linked_project,
                 package.name,
                 osc_filename)
 
-            osc_data_item = find_func(project, str(osc_data))
+            osc_data_item = find_func(project, osc_data)
             if not osc_data_item:
                 raise ValueError(
                     "Could not find a %s in "
@@ -169,8 +366,10 @@ class OBSProject(GerritApiCaller):
         self.obs_linked_project = obs_linked_project
         self.obs_repository = obs_repository
         self.obs_project_description = obs_project_description
+        self.obs_api = OBSApi()
         self._create_test_project()
         self.packages = set()
+        self._is_current = {}
 
     def _create_test_project(self):
         repo_metadata = """
@@ -228,22 +427,100 @@ class OBSProject(GerritApiCaller):
             return None
         return matches[0]
 
+    def get_target_branch_heads(self, branch):
+        """
+        Get the head commits of a branch for all Ardana Gerrit projects,
+        using a single Gerrit query.
+
+        :return: dictionary mapping Gerrit project names (without the
+        'ardana/' prefix) to branch head commits
+        """
+        gerrit_query = "/projects/?p={}&b={}".format(
+            quote_plus('ardana/'), quote_plus(branch))
+        projects = self._query_gerrit(gerrit_query)
+        return dict((name.split('/', 1)[1], project['branches'][branch])
+                    for name, project in projects.items()
+                    if branch in project.get('branches', {}))
+
     def get_target_branch_head(self, package):
+        head_commit = self.get_target_branch_heads(
+            package.target_branch).get(package.gerrit_project)
+        if head_commit:
+            return head_commit
         gerrit_query = "/projects/{}/branches/{}".format(
             quote_plus('ardana/{}'.format(package.gerrit_project)),
             quote_plus(package.target_branch))
         head_commit = self._query_gerrit(gerrit_query)['revision']
         return head_commit
 
+    def get_package_commit(self, package):
+        """
+        Get the git commit that the inherited IBS package was built from.
+        """
+        obsinfo_basename = self._get_obsinfo_basename('_service', package)
+        return self._get_obsinfo_commit(
+            '%s.obsinfo' % obsinfo_basename, package)
+
     def is_current(self, package):
         if package.has_applied_changes():
             return False
-        obsinfo_basename = self._get_obsinfo_basename('_service', package)
-        ibs_package_commit = self._get_obsinfo_commit(
-            '%s.obsinfo' % obsinfo_basename, package)
-        gerrit_branch_commit = self.get_target_branch_head(package)
+        if package.name not in self._is_current:
+            self._is_current[package.name] = \
+                self.get_package_commit(package) == \
+                self.get_target_branch_head(package)
+
+        return self._is_current[package.name]
+
+    def check_current_packages(self, packages, jobs=1):
+        """
+        Determine which of the supplied packages are current in one pass:
+        the Gerrit branch heads are retrieved with a single query, while the
+        IBS package commits are retrieved concurrently.
+        """
+        packages = [package for package in packages
+                    if not package.has_applied_changes() and
+                    package.name not in self._is_current]
+        if not packages:
+            return
+        start = time.time()
+        package_commits = concurrent_map(self.get_package_commit,
+                                         packages, jobs)
+        for package, package_commit in zip(packages, package_commits):
+            self._is_current[package.name] = \
+                package_commit == self.get_target_branch_head(package)
+        print("Checked %d packages in %.1fs, %d are current" %
+              (len(packages), time.time() - start,
+               len([package for package in packages
+                    if self._is_current[package.name]])))
+
+    def prepare_test_package(self, package):
+        """
+        Prepare the git workspace of a package, unless the inherited package
+        is already current, by merging all its queued changes into it.
 
-        return ibs_package_commit == gerrit_branch_commit
+        This step doesn't depend on the current directory and may run
+        concurrently for different packages.
+
+        :return: the time (in seconds) it took to prepare the package
+        """
+        start = time.time()
+        if not self.is_current(package):
+            package.prep_workspace()
+            package.apply_queued_changes()
+        return time.time() - start
+
+    def prepare_test_packages(self, packages, jobs=1):
+        """
+        Prepare the git workspaces of several packages concurrently and
+        report the time it took to prepare each of them.
+        """
+        start = time.time()
+        durations = concurrent_map(self.prepare_test_package, packages, jobs)
+        print("Prepared %d package workspaces in %.1fs:" %
+              (len(packages), time.time() - start))
+        for duration, package in sorted(zip(durations, packages),
+                                        key=lambda item: -item[0]):
+            print("  %s: %.1fs" % (package.name, duration))
 
     def add_test_package(self, package):
         """
@@ -302,57 +579,124 @@ class OBSProject(GerritApiCaller):
             # Workaround to make obs_scm work with a local path.
             # Otherwise it only works with remote URLs.
             env['TAR_SCM_TESTMODE'] = '1'
-            sh.osc('service', 'disabledrun', _env=env)
+            # Source files downloaded by download_files, if the package
+            # uses it, are cached
+            download_cache = DownloadCache()
+            env['CACHEDIRECTORY'] = download_cache.download_dir
+            with download_cache.downloading():
+                # Sources moved to a new URL are served from the cache
+                download_cache.prepare([
+                    url for spec in glob.glob('*.spec')
+                    for url in spec_source_urls(spec)])
+                sh.osc('service', 'disabledrun', _env=env)
+            download_cache.update(glob.glob('*'))
             sh.osc('add', glob.glob('%s*.obscpio' % obsinfo_basename))
             sh.osc('commit', '-m',
                    'Testing gerrit changes applied to %s'
                    % package.applied_change_numbers())
         self.packages.add(package)
 
-    def wait_for_package(self, package):
-        """
-        Wait for a particular package to complete building
-        """
+    # Package build status codes, as reported by OBS, that are final
+    BUILD_SUCCEEDED_CODES = ['succeeded']
+    BUILD_FAILED_CODES = ['failed', 'unresolvable', 'disabled', 'excluded']
+    # 'broken' is sometimes reported transiently, right after the package
+    # sources are updated
+    BUILD_BROKEN_CODES = ['broken']
 
-        print("Waiting for %s to build" % package.name)
-        # cd into the checked out package
-        with cd(os.path.join(self.obs_test_project_name, package.name)):
-            while 'unknown' in sh.osc('results'):
-                print("Waiting for build to be scheduled")
-                time.sleep(3)
-            print("Waiting for build results")
-            for attempt in range(3):
-                results = sh.osc('results', '--watch')
-                print("Build results: %s" % results)
-                if 'broken' in results:
-                    # Sometimes results --watch ends too soon, give it a few
-                    # retries before actually failing
-                    print("Sleeping for 10s before rechecking")
-                    time.sleep(10)
-                    continue
-                else:
-                    break
-
-        if 'succeeded' not in results:
-            print("Package build failed.")
-            return False
-        return True
+    def get_build_results(self):
+        """
+        Get the build status codes of all packages in the test project, with
+        a single OBS API request.
 
-    def wait_for_all_results(self):
+        :return: dictionary mapping package names to lists of build status
+        codes, one for every repository and architecture. Codes reported
+        while the OBS scheduler is still processing a repository are
+        replaced with 'unknown', because they may be outdated.
         """
-        Wait for all the packages to complete building
+        root = ET.fromstring(
+            self.obs_api.build_results(
+                self.obs_test_project_name).encode('utf-8'))
+        results = {}
+        for result in root.findall('result'):
+            outdated = result.get('dirty') == 'true' or \
+                result.get('state') != result.get('code')
+            for status in result.findall('status'):
+                code = 'unknown' if outdated else status.get('code')
+                results.setdefault(status.get('package'), []).append(code)
+        return results
+
+    def wait_for_all_results(self, poll_interval=30, broken_timeout=60,
+                             timeout=OBS_BUILD_TIMEOUT,
+                             missing_polls=OBS_MISSING_POLLS):
         """
-
-        # Check all packages are built
-        # NOTE(jhesketh): this could be optimised to check packages in
-        # parallel. However, the worst case scenario at the moment is
-        # "time for longest package" + "time for num_of_package checks" which
-        # isn't too much more than the minimum
-        # ("time for longest package" + "time for one check")
-        for package in self.packages:
-            result = self.wait_for_package(package)
-            if not result:
-                return False
+        Wait for all the packages to complete building.
+
+        The build results of all packages are polled together. Waiting stops
+        as soon as one of the packages fails to build.
+
+        :param poll_interval: time (in seconds) between two polls
+        :param broken_timeout: time (in seconds) after which a package still
+        reported as broken is considered failed
+        :param timeout: time (in seconds) after which the packages that are
+        still building are considered failed
+        :param missing_polls: number of consecutive polls after which a
+        package still missing from the build results is considered failed
+        :return: True if all packages were built successfully, False
+        otherwise
+        """
+        # Packages that are still building, mapped to the time when they
+        # were first reported as broken
+        building = dict((package.name, None) for package in self.packages)
+        # Number of consecutive polls that did not report a package
+        missing = dict((name, 0) for name in building)
+        states = {}
+        deadline = time.time() + timeout
+        print("Waiting for %d packages to build" % len(building))
+        while building:
+            results = self.get_build_results()
+            now = time.time()
+            for name in sorted(building):
+                codes = results.get(name)
+                if codes is None:
+                    missing[name] += 1
+                    codes = ['missing']
+                else:
+                    missing[name] = 0
+                if missing[name] >= missing_polls:
+                    state = 'failed'
+                elif [code for code in codes
+                        if code in self.BUILD_FAILED_CODES]:
+                    state = 'failed'
+                elif [code for code in codes
+                        if code in self.BUILD_BROKEN_CODES]:
+                    if building[name] is None:
+                        building[name] = now
+                    state = 'failed' \
+                        if now - building[name] >= broken_timeout \
+                        else 'broken'
+                elif all(code in self.BUILD_SUCCEEDED_CODES
+                         for code in codes):
+                    state = 'succeeded'
+                else:
+                    building[name] = None
+                    state = 'building'
+
+                if states.get(name) != state:
+                    print("Package %s: %s (%s)" %
+                          (name, state, ', '.join(codes)))
+                    states[name] = state
+                if state == 'failed':
+                    print("Package build failed.")
+                    return False
+                if state == 'succeeded':
+                    del building[name]
+
+            if building:
+                if time.time() + poll_interval > deadline:
+                    print("Timed out waiting for packages to build: %s" %
+                          ', '.join(sorted(building)))
+                    return False
+                time.sleep(poll_interval)
         return True
 
     def cleanup_test_packages(self):
@@ -370,7 +714,7 @@ def test_project_name(home_project, build_number):
 
 
 def build_test_packages(change_ids, obs_linked_project, home_project,
-                        obs_repository, build_number):
+                        obs_repository, build_number, jobs=1):
 
     print('Attempting to build packages for changes {}'.format(
         ', '.join(change_ids)))
@@ -382,7 +726,7 @@ def build_test_packages(change_ids, obs_linked_project, home_project,
     # Grab each change for the supplied change_ids
     changes = []
     for id in change_ids:
-        c = GerritChange(id, branch=branch)
+        c = GerritChange(id, branch=branch, refresh=True)
         branch = branch or c.branch
         changes.append(c)
         # Add the dependent changes to the changes list to process
@@ -412,12 +756,16 @@ def build_test_packages(change_ids, obs_linked_project, home_project,
         obs_test_project_name, obs_linked_project, obs_repository,
         obs_test_project_description)
 
+    git_cache = GitCache() if GIT_CACHE else None
+
     # Keep track of processed changes
     processed_changes = []
     # Keep track of the packages to build as a dict of
     # 'gerrit_project': Package()
     packages = {}
 
+    project_map = gerrit_project_map(branch)
+
     # We process the supplied changes, as well as their dependencies.
     # If a change has already been processed we skip it to avoid circular
     # dependencies.
@@ -428,7 +776,7 @@ def build_test_packages(change_ids, obs_linked_project, home_project,
         processed_changes.append(c)
 
         # skip packages that don't have asssociated RPMs
-        if c.gerrit_project not in gerrit_project_map(branch):
+        if c.gerrit_project not in project_map:
             print("Warning: Project %s has no RPM, Skipping"
                   % c.gerrit_project)
         else:
@@ -438,17 +786,25 @@ def build_test_packages(change_ids, obs_linked_project, home_project,
                 #       the target branch for that package. All subsquent
                 #       changes must match the target branch.
                 packages[c.gerrit_project] = OBSPackage(
-                    c.gerrit_project, c.url, c.branch, source_workspace)
+                    c.gerrit_project, c.url, c.branch, source_workspace,
+                    git_cache)
 
-            # Merge the change into the package
-            packages[c.gerrit_project].add_change(c)
+            # Queue the change to be merged into the package
+            packages[c.gerrit_project].queue_change(c)
 
-    for project_name, package in gerrit_project_map(branch).items():
+    for project_name, package in project_map.items():
         if project_name in packages:
             continue
         url = GERRIT_URL + "/ardana/" + project_name
         packages[project_name] = OBSPackage(
-            project_name, url, branch, source_workspace)
+            project_name, url, branch, source_workspace, git_cache)
+
+    # Determine which packages don't need to be rebuilt and prepare the
+    # workspaces for the others, concurrently
+    obs_project.check_current_packages(list(packages.values()), jobs)
+    obs_project.prepare_test_packages(list(packages.values()), jobs)
+    if git_cache:
+        git_cache.prune()
 
     # Add the packages into the obs project and begin building them
     for project_name, package in packages.items():
@@ -488,11 +844,14 @@ def main():
     parser.add_argument('--repository', default=None,
                         help='Name of the repository in OBS against which to '
                              'build the test packages (e.g. SLE_12_SP4)')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='Maximum number of package workspaces prepared '
+                             'concurrently')
     args = parser.parse_args()
 
     results = build_test_packages(
         args.changes, args.develproject, args.homeproject, args.repository,
-        args.buildnumber)
+        args.buildnumber, args.jobs)
 
     if not results:
         sys.exit(1)
@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+# vim: sw=4 et
+
+# Copyright (c) 2019 SUSE LINUX GmbH, Nuernberg, Germany.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Content-addressed cache for the source files downloaded by the
+download_files OBS source service.
+
+download_files already supports a cache directory (CACHEDIRECTORY), where
+each downloaded file is stored as file/<url hash>, with its name stored in
+filename/<url hash>. This module manages that directory:
+
+* downloaded files are ingested into a content-addressed object store
+  (objects/<sha256>), and the file/<url hash> entries are replaced with
+  hard links to the stored objects, so that identical files downloaded
+  from different URLs are only stored once
+* an index maps URL hashes to content checksums and file names, and tracks
+  the size and last use of every object
+* before download_files runs, the source URLs of a spec file that are not
+  cached yet, but whose file name is known to the index (e.g. a tarball
+  moved to a different location), are linked to the stored object, so
+  that download_files finds them in the cache instead of downloading them
+* the least recently used objects, and the downloads referencing them, are
+  evicted when the cache grows beyond its maximum size
+
+download_files never writes into an existing cache entry, so the hard
+links are only ever read.
+
+Builds hold a shared lock while download_files writes into the cache.
+Downloads are only ingested and evicted when no build holds that lock,
+i.e. by the last of several concurrent builds to finish. Updates of the
+index are serialized with a separate lock.
+
+The module is also used by hostscripts/rpm-packaging/createproject.py, when
+found on the python path.
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import re
+import time
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+DOWNLOAD_CACHE_DIR = os.environ.get(
+    'DOWNLOAD_CACHE_DIR',
+    os.path.join(os.path.expanduser("~"), ".cache", "download_files"))
+# Maximum size (in bytes) of the cached files
+DOWNLOAD_CACHE_SIZE = int(os.environ.get('DOWNLOAD_CACHE_SIZE',
+                                         20 * 1024 ** 3))
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def url_key(url):
+    """
+    Compute the key under which download_files caches the file downloaded
+    from a URL (the sha256 checksum of the "echo $url" output).
+    """
+    return hashlib.sha256((url + '\n').encode('utf-8')).hexdigest()
+
+
+def url_filename(url):
+    """Get the name of the file download_files saves a URL to"""
+    parsed = urlparse(url)
+    if parsed.fragment.startswith('/'):
+        # OBS convention used to rename the downloaded file
+        return os.path.basename(parsed.fragment)
+    return os.path.basename(parsed.path)
+
+
+SPEC_TAG_RE = re.compile(r'^(Name|Version|Release):\s*(\S+)\s*$',
+                         re.IGNORECASE | re.MULTILINE)
+SPEC_DEFINE_RE = re.compile(r'^%(?:define|global)\s+(\w+)\s+(\S+)\s*$',
+                            re.MULTILINE)
+SPEC_SOURCE_RE = re.compile(r'^Source\d*:\s*(\w+://\S+)\s*$',
+                            re.IGNORECASE | re.MULTILINE)
+SPEC_MACRO_RE = re.compile(r'%\{?(\w+)\}?')
+
+
+def spec_source_urls(spec_path):
+    """
+    Get the remote source URLs of a spec file, with the simple macros
+    (tags, %define and %global) expanded. URLs using other macros are
+    skipped.
+    """
+    with open(spec_path) as spec_file:
+        spec = spec_file.read()
+    macros = dict((name.lower(), value)
+                  for name, value in SPEC_TAG_RE.findall(spec))
+    macros.update(SPEC_DEFINE_RE.findall(spec))
+    urls = []
+    for url in SPEC_SOURCE_RE.findall(spec):
+        # Macros may be defined in terms of other macros
+        for _ in range(5):
+            url = SPEC_MACRO_RE.sub(
+                lambda match: macros.get(match.group(1), match.group(0)),
+                url)
+        if '%' not in url:
+            urls.append(url)
+    return urls
+
+
+class DownloadCache(object):
+
+    def __init__(self, cache_dir=DOWNLOAD_CACHE_DIR,
+                 max_size=DOWNLOAD_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.file_dir = os.path.join(cache_dir, 'file')
+        self.filename_dir = os.path.join(cache_dir, 'filename')
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        for path in [self.objects_dir, self.file_dir, self.filename_dir]:
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # Created concurrently
+                    pass
+
+    @property
+    def download_dir(self):
+        """The CACHEDIRECTORY value to be used with download_files"""
+        return self.cache_dir
+
+    @contextlib.contextmanager
+    def _downloads_lock(self, shared=False, blocking=True):
+        """
+        Hold the lock guarding the downloaded files.
+
+        :return: True if the lock was acquired, False if blocking is False and
+        the lock is held by someone else
+        """
+        with open(os.path.join(self.cache_dir, '.downloads.lock'),
+                  'a') as lock_file:
+            flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(lock_file, flags)
+            except IOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def downloading(self):
+        """
+        Keep the downloaded files from being ingested or evicted while
+        download_files runs with this cache.
+        """
+        with self._downloads_lock(shared=True):
+            yield
+
+    @contextlib.contextmanager
+    def _locked_index(self):
+        """
+        Lock the cache and yield its index, which is saved on exit.
+        """
+        with open(os.path.join(self.cache_dir, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.index_path) as index_file:
+                        index = json.load(index_file)
+                except (IOError, OSError, ValueError):
+                    index = {'urls': {}, 'objects': {}}
+                yield index
+                with open(self.index_path + '.tmp', 'w') as index_file:
+                    json.dump(index, index_file)
+                os.rename(self.index_path + '.tmp', self.index_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _object_path(self, sha256):
+        return os.path.join(self.objects_dir, sha256)
+
+    def _link(self, src, dst):
+        tmp = '%s.%d.tmp' % (dst, os.getpid())
+        os.link(src, tmp)
+        os.rename(tmp, dst)
+
+    def _remove_url(self, index, url_key):
+        index['urls'].pop(url_key, None)
+        for path in [os.path.join(self.file_dir, url_key),
+                     os.path.join(self.filename_dir, url_key)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _remove_object(self, index, sha256):
+        for url_key, url in list(index['urls'].items()):
+            if url['sha256'] == sha256:
+                self._remove_url(index, url_key)
+        index['objects'].pop(sha256, None)
+        if os.path.exists(self._object_path(sha256)):
+            os.remove(self._object_path(sha256))
+
+    def ingest(self):
+        """
+        Move the files newly downloaded by download_files into the object
+        store and index them. Must not be called while downloads are in
+        progress (see update).
+
+        :return: the number of ingested files
+        """
+        ingested = 0
+        with self._locked_index() as index:
+            now = time.time()
+            for url_key in os.listdir(self.file_dir):
+                path = os.path.join(self.file_dir, url_key)
+                if url_key.endswith('.tmp') or not os.path.isfile(path):
+                    continue
+                url = index['urls'].get(url_key)
+                if url and os.path.exists(self._object_path(url['sha256'])) \
+                        and os.path.samefile(
+                            path, self._object_path(url['sha256'])):
+                    continue
+                sha256 = file_sha256(path)
+                object_path = self._object_path(sha256)
+                if os.path.exists(object_path):
+                    # Same contents as a file downloaded from another URL
+                    self._link(object_path, path)
+                else:
+                    os.link(path, object_path)
+                filename = None
+                filename_path = os.path.join(self.filename_dir, url_key)
+                if os.path.exists(filename_path):
+                    with open(filename_path) as filename_file:
+                        filename = filename_file.read().strip()
+                index['urls'][url_key] = {'sha256': sha256,
+                                          'filename': filename}
+                index['objects'][sha256] = {
+                    'size': os.path.getsize(object_path),
+                    'accessed': now}
+                ingested += 1
+            # Forget about files removed from the cache by other means
+            for url_key in list(index['urls']):
+                if not os.path.exists(os.path.join(self.file_dir, url_key)):
+                    index['urls'].pop(url_key)
+        return ingested
+
+    def prepare(self, urls):
+        """
+        Link the URLs about to be downloaded, which are not cached yet, to
+        the stored object downloaded earlier under the same file name, if
+        there is exactly one.
+
+        :param urls: source URLs (e.g. as returned by spec_source_urls)
+        :return: the number of URLs served from the object store
+        """
+        prepared = 0
+        with self._locked_index() as index:
+            by_filename = {}
+            for url in index['urls'].values():
+                by_filename.setdefault(url['filename'], set()).add(
+                    url['sha256'])
+            now = time.time()
+            for url in urls:
+                key = url_key(url)
+                if os.path.exists(os.path.join(self.file_dir, key)):
+                    continue
+                filename = url_filename(url)
+                candidates = by_filename.get(filename, set())
+                if len(candidates) != 1:
+                    continue
+                sha256 = next(iter(candidates))
+                if not os.path.exists(self._object_path(sha256)):
+                    continue
+                with open(os.path.join(self.filename_dir, key),
+                          'w') as filename_file:
+                    filename_file.write(filename + '\n')
+                self._link(self._object_path(sha256),
+                           os.path.join(self.file_dir, key))
+                index['urls'][key] = {'sha256': sha256, 'filename': filename}
+                index['objects'][sha256]['accessed'] = now
+                print('Using cached %s for %s' % (filename, url))
+                prepared += 1
+        return prepared
+
+    def touch(self, paths):
+        """
+        Record the use of cached files, identified by the names and sizes of
+        the files copied from the cache by download_files.
+        """
+        with self._locked_index() as index:
+            by_filename = {}
+            for url in index['urls'].values():
+                by_filename.setdefault(url['filename'], []).append(
+                    url['sha256'])
+            now = time.time()
+            for path in paths:
+                for sha256 in by_filename.get(os.path.basename(path), []):
+                    cached = index['objects'].get(sha256)
+                    if cached and os.path.isfile(path) and \
+                            os.path.getsize(path) == cached['size']:
+                        cached['accessed'] = now
+
+    def evict(self):
+        """
+        Remove the least recently used objects, and the cache entries
+        linked to them, until the cache size drops below the
+        configured limit. Must not be called while downloads are in
+        progress (see update).
+
+        :return: the number of removed objects
+        """
+        removed = 0
+        with self._locked_index() as index:
+            size = sum(o['size'] for o in index['objects'].values())
+            for sha256, cached in sorted(index['objects'].items(),
+                                         key=lambda item: item[1]['accessed']):
+                if size <= self.max_size:
+                    break
+                self._remove_object(index, sha256)
+                size -= cached['size']
+                removed += 1
+        return removed
+
+    def verify(self):
+        """
+        Check the integrity of all cached objects and remove the corrupted
+        ones, as well as the cache entries no longer linked to them. Must
+        not be called while downloads are in progress (see update).
+
+        :return: the number of removed files
+        """
+        removed = 0
+        with self._locked_index() as index:
+            for sha256 in list(index['objects']):
+                object_path = self._object_path(sha256)
+                if not os.path.exists(object_path) or \
+                        file_sha256(object_path) != sha256:
+                    print('Removing corrupted cached file %s' % sha256)
+                    self._remove_object(index, sha256)
+                    removed += 1
+            for url_key, url in list(index['urls'].items()):
+                path = os.path.join(self.file_dir, url_key)
+                object_path = self._object_path(url['sha256'])
+                if not os.path.exists(path) or \
+                        not os.path.exists(object_path) or \
+                        not os.path.samefile(path, object_path):
+                    print('Removing unlinked download %s' % url_key)
+                    self._remove_url(index, url_key)
+                    removed += 1
+        return removed
+
+    def update(self, paths=()):
+        """
+        Ingest new downloads, record the use of cached files and evict the
+        least recently used ones, if needed.
+
+        New downloads are only ingested, and files evicted, if no other
+        build is downloading files into the cache. Otherwise this is left
+        to the last build to finish.
+        """
+        with self._downloads_lock(blocking=False) as idle:
+            if idle:
+                self.ingest()
+            self.touch(paths)
+            if idle:
+                self.evict()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Maintain the download_files source cache')
+    parser.add_argument('--cache-dir', default=DOWNLOAD_CACHE_DIR,
+                        help='cache directory')
+    parser.add_argument('--max-size', type=int, default=DOWNLOAD_CACHE_SIZE,
+                        help='maximum cache size, in bytes')
+    parser.add_argument('--verify', action='store_true',
+                        help='check the integrity of all cached files')
+    args = parser.parse_args()
+
+    cache = DownloadCache(args.cache_dir, args.max_size)
+    with cache._downloads_lock():
+        print('Ingested %d files' % cache.ingest())
+        if args.verify:
+            print('Removed %d corrupted files' % cache.verify())
+        print('Evicted %d files' % cache.evict())
+
+
+if __name__ == '__main__':
+    main()
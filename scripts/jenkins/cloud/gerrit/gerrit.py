@@ -4,8 +4,12 @@ import argparse
 import json
 import os
 import re
+import sqlite3
 import sys
+import threading
+import time
 from functools import partial
+from multiprocessing.pool import ThreadPool
 
 try:
     from pygerrit2 import GerritRestAPI, GerritReview, HTTPBasicAuthFromNetrc
@@ -14,11 +18,55 @@ except ImportError:
     pass
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 GERRIT_URL = 'https://gerrit.prv.suse.net'
 
 GERRIT_VERIFY = os.environ.get('GERRIT_VERIFY', True) in ['true', '1', True]
 
+# All Gerrit REST API calls share a pool of persistent HTTP connections
+GERRIT_POOL_SIZE = int(os.environ.get('GERRIT_POOL_SIZE', 10))
+# Number of times failed requests (connection errors, timeouts or 5xx
+# responses) are retried, with an exponential backoff between attempts
+GERRIT_RETRIES = int(os.environ.get('GERRIT_RETRIES', 5))
+GERRIT_RETRY_BACKOFF = float(os.environ.get('GERRIT_RETRY_BACKOFF', 0.5))
+GERRIT_TIMEOUT = float(os.environ.get('GERRIT_TIMEOUT', 60))
+# Maximum number of Gerrit queries running concurrently (e.g. while walking
+# the dependency graph of a change)
+GERRIT_CONCURRENCY = int(os.environ.get('GERRIT_CONCURRENCY', 8))
+
+# Query options used to load the change information for all patchsets
+ALL_REVISIONS_QUERY_OPTIONS = 'o=ALL_REVISIONS&o=ALL_COMMITS&o=SUBMITTABLE'
+# Query options used to load the change information for the current
+# patchset only
+CURRENT_REVISION_QUERY_OPTIONS = \
+    'o=CURRENT_REVISION&o=CURRENT_COMMIT&o=SUBMITTABLE'
+
+# Maximum number of changes looked up with a single Gerrit query, to keep
+# the query URL length within reasonable limits
+CHANGE_QUERY_CHUNK_SIZE = 25
+
+# Gerrit query responses are also cached on disk and shared between the
+# short-lived processes running on the same host
+GERRIT_CACHE = os.environ.get('GERRIT_CACHE', True) in ['true', '1', True]
+GERRIT_CACHE_DIR = os.environ.get(
+    'GERRIT_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'gerrit'))
+# Maximum size (in bytes) of the cached query responses
+GERRIT_CACHE_SIZE = int(os.environ.get('GERRIT_CACHE_SIZE', 64 * 1024 * 1024))
+# How long (in seconds) a cached query response is considered valid, for
+# each query class. Change set queries (/changes/?q=...) may start matching
+# new changes at any time, which doesn't invalidate their cached responses,
+# so these are never reused by other processes, or by the events handled by
+# long-running processes.
+GERRIT_CACHE_TTL = {
+    'change': 120,
+    'related': 120,
+    'query': 0,
+    'project': 60,
+}
+
 # We use a more complex regex that matches both formats of Depends-On so that
 # we preserve the order in which they are discovered.
 DEPENDS_ON_RE = re.compile(
@@ -32,6 +80,22 @@ DEPENDS_ON_RE = re.compile(
 print_err = partial(print, file=sys.stderr)
 
 
+def concurrent_map(func, items, concurrency=GERRIT_CONCURRENCY):
+    """
+    Apply a function to every item in a list using a pool of worker
+    threads, and return the results in the same order as the items.
+    """
+    items = list(items)
+    if len(items) <= 1 or concurrency <= 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(min(concurrency, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def argparse_gerrit_change_type(change_id):
     change_regex = re.compile(r"^[0-9]+(/[0-9]+)?$")
     if not change_regex.match(change_id):
@@ -40,22 +104,344 @@ def argparse_gerrit_change_type(change_id):
     return change_id
 
 
+class GerritQueryCache:
+    """
+    Persistent, size-bounded cache of Gerrit query responses, stored in a
+    sqlite database shared by all processes running on the same host.
+
+    Cached responses expire after a TTL that depends on the query class.
+    They are also invalidated as soon as a more recent version (i.e. a newer
+    'updated' timestamp) is seen for any of the changes they reference. When
+    the cache grows beyond its maximum size, the least recently used
+    responses are evicted first.
+    """
+
+    CHANGE_QUERY_RE = re.compile(r'^/changes/(\d+)/')
+
+    def __init__(self, cache_dir, max_size):
+        self.path = os.path.join(cache_dir, 'query-cache.sqlite')
+        self.max_size = max_size
+        # sqlite connections cannot be shared between threads
+        self._local = threading.local()
+
+    @staticmethod
+    def query_class(query):
+        if query.startswith('/projects/'):
+            return 'project'
+        if query.startswith('/changes/?'):
+            return 'query'
+        if query.endswith('/related'):
+            return 'related'
+        return 'change'
+
+    @staticmethod
+    def _change_refs(result):
+        """
+        Collect the number and 'updated' timestamp of all change objects
+        included in a query response.
+        """
+        change_objects = result if isinstance(result, list) else [result]
+        return dict([(str(co['_number']), co['updated'])
+                     for co in change_objects
+                     if isinstance(co, dict) and
+                     '_number' in co and 'updated' in co])
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            if not os.path.exists(os.path.dirname(self.path)):
+                try:
+                    os.makedirs(os.path.dirname(self.path))
+                except OSError:
+                    # Created in the meantime by another thread or process
+                    if not os.path.isdir(os.path.dirname(self.path)):
+                        raise
+            db = self._local.db = sqlite3.connect(self.path, timeout=30)
+            with db:
+                db.execute(
+                    'CREATE TABLE IF NOT EXISTS responses ('
+                    'query TEXT PRIMARY KEY, response TEXT, '
+                    'created REAL, accessed REAL, size INTEGER, refs TEXT)')
+                db.execute(
+                    'CREATE TABLE IF NOT EXISTS changes ('
+                    'number TEXT PRIMARY KEY, updated TEXT)')
+        return db
+
+    def _known_updates(self, db, numbers):
+        if not numbers:
+            return {}
+        rows = db.execute(
+            'SELECT number, updated FROM changes WHERE number IN ({})'.format(
+                ','.join('?' * len(numbers))),
+            list(numbers))
+        return dict(rows.fetchall())
+
+    def get(self, query):
+        """
+        Return the cached response text for the given query, or None if
+        the query isn't cached or the cached response is no longer valid.
+        """
+        db = self._connect()
+        now = time.time()
+        with db:
+            row = db.execute(
+                'SELECT response, created, refs FROM responses '
+                'WHERE query = ?', (query,)).fetchone()
+            if row is None:
+                return None
+            response, created, refs = row
+            refs = json.loads(refs)
+            ttl = GERRIT_CACHE_TTL[self.query_class(query)]
+            known_updates = self._known_updates(db, refs.keys())
+            if now - created > ttl or any(
+                    known_updates.get(number) != updated
+                    for number, updated in refs.items()):
+                db.execute('DELETE FROM responses WHERE query = ?', (query,))
+                return None
+            db.execute('UPDATE responses SET accessed = ? WHERE query = ?',
+                       (now, query))
+        return response
+
+    def put(self, query, response, result):
+        """
+        Store the response text and update the known change timestamps
+        with those included in the parsed result. Only the timestamps are
+        recorded for the query classes that are not cached.
+        """
+        db = self._connect()
+        now = time.time()
+        refs = self._change_refs(result)
+        with db:
+            for number, updated in refs.items():
+                db.execute(
+                    'INSERT OR IGNORE INTO changes VALUES (?, ?)',
+                    (number, updated))
+                db.execute(
+                    'UPDATE changes SET updated = ? '
+                    'WHERE number = ? AND updated < ?',
+                    (updated, number, updated))
+            if GERRIT_CACHE_TTL[self.query_class(query)] <= 0:
+                return
+            # Responses that don't include the change object itself (e.g.
+            # related changes) are tied to the most recently seen version
+            # of the change they were queried for
+            match = self.CHANGE_QUERY_RE.match(query)
+            if match and match.group(1) not in refs:
+                number = match.group(1)
+                refs[number] = self._known_updates(
+                    db, [number]).get(number)
+            db.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                (query, response, now, now, len(response), json.dumps(refs)))
+            self._evict(db)
+
+    def invalidate(self, change_number):
+        """
+        Invalidate all cached responses referencing the given change.
+        """
+        db = self._connect()
+        with db:
+            # An empty timestamp doesn't match any recorded value, yet it
+            # is older than any real timestamp reported by Gerrit
+            db.execute('INSERT OR REPLACE INTO changes VALUES (?, ?)',
+                       (str(change_number), ''))
+
+    def _evict(self, db):
+        total_size = db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        evicted = []
+        for query, size in db.execute(
+                'SELECT query, size FROM responses ORDER BY accessed'):
+            if total_size <= self.max_size:
+                break
+            evicted.append((query,))
+            total_size -= size
+        db.executemany('DELETE FROM responses WHERE query = ?', evicted)
+
+
 class GerritApiCaller:
     _CACHE = {}
+    # Time when each response was cached in memory. In-memory responses
+    # are kept for the lifetime of the process, unless cache expiry is
+    # enabled by long-running processes.
+    _CACHE_CREATED = {}
+    _CACHE_EXPIRY = False
+    _DISK_CACHE = GerritQueryCache(GERRIT_CACHE_DIR, GERRIT_CACHE_SIZE) \
+        if GERRIT_CACHE else None
+    _SESSION = None
+    _REST_API = None
+    _LOCK = threading.RLock()
+    # Queries currently being run, mapped to events signaled on completion
+    _IN_FLIGHT = {}
+    _QUERY_SEMAPHORE = threading.BoundedSemaphore(GERRIT_CONCURRENCY)
 
     @staticmethod
-    def _query_gerrit(query):
-        if query in GerritApiCaller._CACHE:
-            return GerritApiCaller._CACHE[query]
-
-        query_url = GERRIT_URL + query
-        print_err("Running query %s" % query_url)
-        response = requests.get(query_url, verify=GERRIT_VERIFY)
-        print_err("Got response: %s" % response)
-        GerritApiCaller._CACHE[query] = result = \
-            json.loads(response.text.replace(")]}'", ''))
+    def _session():
+        """
+        Get the HTTP session shared by all Gerrit REST API calls, which
+        keeps a pool of connections alive and retries failed requests.
+        """
+        with GerritApiCaller._LOCK:
+            if GerritApiCaller._SESSION is None:
+                GerritApiCaller._SESSION = GerritApiCaller._new_session()
+        return GerritApiCaller._SESSION
+
+    @staticmethod
+    def _new_session():
+        session = requests.Session()
+        retry = Retry(total=GERRIT_RETRIES,
+                      backoff_factor=GERRIT_RETRY_BACKOFF,
+                      status_forcelist=(500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=GERRIT_POOL_SIZE,
+                              max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip, deflate'})
+        return session
+
+    @staticmethod
+    def _rest_api():
+        """
+        Get the authenticated pygerrit2 REST API client used to update
+        Gerrit changes, sharing the same HTTP session as the queries.
+        """
+        with GerritApiCaller._LOCK:
+            if GerritApiCaller._REST_API is None:
+                auth = HTTPBasicAuthFromNetrc(url=GERRIT_URL)
+                rest = GerritRestAPI(url=GERRIT_URL, auth=auth,
+                                     verify=GERRIT_VERIFY)
+                rest.session = GerritApiCaller._session()
+                GerritApiCaller._REST_API = rest
+        return GerritApiCaller._REST_API
+
+    @staticmethod
+    def _disk_cache_call(method, *args):
+        if GerritApiCaller._DISK_CACHE is None:
+            return None
+        try:
+            return getattr(GerritApiCaller._DISK_CACHE, method)(*args)
+        except (sqlite3.Error, OSError, IOError) as e:
+            # The disk cache is an optimization - don't let it get in the way
+            print_err("Disabling Gerrit query disk cache: %s" % e)
+            GerritApiCaller._DISK_CACHE = None
+            return None
+
+    @staticmethod
+    def _query_gerrit(query, refresh=False):
+        if refresh:
+            return GerritApiCaller._run_query(query, refresh)
+
+        # Identical queries issued concurrently by different threads are
+        # only run once, the other threads wait for the result
+        with GerritApiCaller._LOCK:
+            if GerritApiCaller._cache_valid(query):
+                return GerritApiCaller._CACHE[query]
+            in_flight = GerritApiCaller._IN_FLIGHT.get(query)
+            if in_flight is None:
+                GerritApiCaller._IN_FLIGHT[query] = threading.Event()
+            waiting_since = time.time()
+
+        if in_flight is not None:
+            in_flight.wait()
+            # The response received by the other thread is used even if it
+            # already expired
+            with GerritApiCaller._LOCK:
+                if GerritApiCaller._CACHE_CREATED.get(
+                        query, 0) >= waiting_since and \
+                        query in GerritApiCaller._CACHE:
+                    return GerritApiCaller._CACHE[query]
+            # The query failed in the other thread, try again here
+            return GerritApiCaller._run_query(query)
+
+        try:
+            return GerritApiCaller._run_query(query)
+        finally:
+            with GerritApiCaller._LOCK:
+                GerritApiCaller._IN_FLIGHT.pop(query).set()
+
+    @staticmethod
+    def _run_query(query, refresh=False):
+        response_text = None
+        if not refresh:
+            response_text = GerritApiCaller._disk_cache_call('get', query)
+        if response_text is not None:
+            print_err("Using cached response for query %s" % query)
+            result = json.loads(response_text)
+        else:
+            query_url = GERRIT_URL + query
+            print_err("Running query %s" % query_url)
+            with GerritApiCaller._QUERY_SEMAPHORE:
+                response = GerritApiCaller._session().get(
+                    query_url, verify=GERRIT_VERIFY, timeout=GERRIT_TIMEOUT)
+            print_err("Got response: %s" % response)
+            response_text = response.text.replace(")]}'", '')
+            result = json.loads(response_text)
+            if response.ok:
+                GerritApiCaller._disk_cache_call(
+                    'put', query, response_text, result)
+
+        GerritApiCaller._cache_put(query, result)
         return result
 
+    @staticmethod
+    def _cache_valid(query):
+        if query not in GerritApiCaller._CACHE:
+            return False
+        if not GerritApiCaller._CACHE_EXPIRY:
+            return True
+        ttl = GERRIT_CACHE_TTL[GerritQueryCache.query_class(query)]
+        return time.time() - GerritApiCaller._CACHE_CREATED[query] <= ttl
+
+    @staticmethod
+    def _cache_put(query, result, replace=True):
+        with GerritApiCaller._LOCK:
+            if not replace and GerritApiCaller._cache_valid(query):
+                return
+            GerritApiCaller._CACHE[query] = result
+            GerritApiCaller._CACHE_CREATED[query] = time.time()
+
+    @staticmethod
+    def enable_cache_expiry():
+        """
+        Expire the query responses cached in memory after the same TTL
+        as those cached on disk. Used by long-running processes, which
+        would otherwise keep serving stale responses.
+        """
+        GerritApiCaller._CACHE_EXPIRY = True
+
+    @staticmethod
+    def purge_expired_cache():
+        """
+        Drop the expired query responses cached in memory.
+        """
+        with GerritApiCaller._LOCK:
+            for query in list(GerritApiCaller._CACHE):
+                if not GerritApiCaller._cache_valid(query):
+                    del GerritApiCaller._CACHE[query]
+                    GerritApiCaller._CACHE_CREATED.pop(query, None)
+
+    @staticmethod
+    def _invalidate_change(change_number):
+        """
+        Drop all cached query responses pertaining to a change, e.g. after
+        it has been updated, including the responses of queries that
+        returned it along with other changes.
+        """
+        prefix = '/changes/{}/'.format(change_number)
+        with GerritApiCaller._LOCK:
+            for query, result in list(GerritApiCaller._CACHE.items()):
+                if query.startswith(prefix) or \
+                        str(change_number) in GerritQueryCache._change_refs(
+                            result):
+                    del GerritApiCaller._CACHE[query]
+                    GerritApiCaller._CACHE_CREATED.pop(query, None)
+        GerritApiCaller._disk_cache_call('invalidate', change_number)
+
 
 class GerritChange(GerritApiCaller):
     """
@@ -68,17 +454,38 @@ class GerritChange(GerritApiCaller):
     def __hash__(self):
         return hash(self.id)
 
+    # Attributes that are only available when the change object includes
+    # revision information
+    _REVISION_ATTRIBUTES = [
+        'revision', 'current_revision', 'is_current', 'patchset', 'url',
+        'ref', 'subject', 'commit_message', 'parent_revisions', 'mergeable',
+        'submittable', 'gerrit_url'
+    ]
+
+    def __getattr__(self, name):
+        # Changes requested without a patchset are initially loaded without
+        # revision information. The revision information is only loaded
+        # the first time one of the attributes that require it is accessed.
+        if name in GerritChange._REVISION_ATTRIBUTES and \
+                '_change_object' in self.__dict__ and \
+                'revisions' not in self._change_object:
+            self._load_current_revision()
+            return getattr(self, name)
+        raise AttributeError(name)
+
     def __init__(self, change_id=None, branch=None,
-                 patchset=None, change_object=None):
+                 patchset=None, change_object=None, refresh=False):
         if change_id:
             print_err("Processing given change id: %s" % change_id)
             if change_id.isdigit():
-                self._get_numeric_change(change_id, branch, patchset)
+                self._get_numeric_change(change_id, branch, patchset,
+                                         refresh)
             elif change_id.split('/')[0].isdigit():
                 change_id, patchset = change_id.split('/')
-                self._get_numeric_change(change_id, branch, patchset)
+                self._get_numeric_change(change_id, branch, patchset,
+                                         refresh)
             elif change_id.startswith('I') and len(change_id) == 41:
-                self._get_change_id(change_id, branch, patchset)
+                self._get_change_id(change_id, branch, patchset, refresh)
             else:
                 raise Exception("Unknown change id format (%s)" % change_id)
         elif change_object:
@@ -94,13 +501,15 @@ class GerritChange(GerritApiCaller):
         self._implicit_dependencies = None
         self._related_changes = None
 
-    def _get_numeric_change(self, change_id, branch=None, patchset=None):
+    def _get_numeric_change(self, change_id, branch=None, patchset=None,
+                            refresh=False):
         """
         Get a change object from a deterministic numeric change number
         """
         query = '/changes/{}/'.format(change_id)
-        query += '?o=ALL_REVISIONS&o=ALL_COMMITS&o=SUBMITTABLE'
-        response_json = self._query_gerrit(query)
+        if patchset:
+            query += '?' + ALL_REVISIONS_QUERY_OPTIONS
+        response_json = self._query_gerrit(query, refresh)
 
         if branch and response_json['branch'] != branch:
             raise Exception("Change {} does not target branch {}".format(
@@ -108,7 +517,8 @@ class GerritChange(GerritApiCaller):
 
         self._set_change_object(response_json)
 
-    def _get_change_id(self, change_id, branch=None, patchset=None):
+    def _get_change_id(self, change_id, branch=None, patchset=None,
+                       refresh=False):
         """
         Get a change object from an ambiguous change ID and matching the
         given branch
@@ -116,8 +526,9 @@ class GerritChange(GerritApiCaller):
         query = '/changes/?q={}'.format(change_id)
         if branch:
             query += '+branch:{}'.format(branch)
-        query += '&o=ALL_REVISIONS&o=ALL_COMMITS&o=SUBMITTABLE'
-        response_json = self._query_gerrit(query)
+        if patchset:
+            query += '&' + ALL_REVISIONS_QUERY_OPTIONS
+        response_json = self._query_gerrit(query, refresh)
 
         if len(response_json) > 1:
             raise Exception(
@@ -133,14 +544,116 @@ class GerritChange(GerritApiCaller):
 
         self._set_change_object(response_json[0])
 
+    @staticmethod
+    def get_changes(change_ids, branch=None, concurrency=GERRIT_CONCURRENCY):
+        """
+        Look up several changes at once, using as few Gerrit queries as
+        possible: the supplied change IDs are combined into OR queries,
+        each looking up at most CHANGE_QUERY_CHUNK_SIZE changes.
+
+        :param change_ids: list of change numbers, optionally followed by a
+        patchset number (e.g. 1234 or 1234/1), or Change-Id values. The
+        information for all patchsets is only loaded if at least one of them
+        includes a patchset number.
+        :param branch: the target branch that all changes must match. Also
+        used to disambiguate Change-Id values.
+        :param concurrency: maximum number of queries run concurrently
+        :return: list of GerritChange objects, in the same order as the
+        supplied change IDs
+        """
+        change_ids = list(change_ids)
+        query_options = CURRENT_REVISION_QUERY_OPTIONS
+        if [change_id for change_id in change_ids if '/' in change_id]:
+            query_options = ALL_REVISIONS_QUERY_OPTIONS
+        unique_ids = []
+        for change_id in change_ids:
+            change_id = change_id.split('/')[0]
+            if change_id not in unique_ids:
+                unique_ids.append(change_id)
+
+        def query_changes(chunk):
+            terms = []
+            for change_id in chunk:
+                if change_id.isdigit():
+                    terms.append('change:{}'.format(change_id))
+                elif change_id.startswith('I') and len(change_id) == 41:
+                    if branch:
+                        terms.append('(change:{}+branch:{})'.format(
+                            change_id, branch))
+                    else:
+                        terms.append('change:{}'.format(change_id))
+                else:
+                    raise Exception(
+                        "Unknown change id format (%s)" % change_id)
+            query = '/changes/?q={}&{}'.format('+OR+'.join(terms),
+                                               query_options)
+            return GerritApiCaller._query_gerrit(query)
+
+        chunks = [unique_ids[idx:idx + CHANGE_QUERY_CHUNK_SIZE]
+                  for idx in range(0, len(unique_ids),
+                                   CHANGE_QUERY_CHUNK_SIZE)]
+        change_objects = {}
+        loaded_numbers = set()
+        for response_json in concurrent_map(query_changes, chunks,
+                                            concurrency):
+            for change_object in response_json:
+                number = str(change_object['_number'])
+                if number in loaded_numbers:
+                    continue
+                loaded_numbers.add(number)
+                change_objects.setdefault(number, []).append(change_object)
+                change_objects.setdefault(
+                    change_object['change_id'], []).append(change_object)
+                # Subsequent lookups by change number are served from the
+                # combined query response
+                for query in ['/changes/{}/'.format(number),
+                              '/changes/{}/?{}'.format(number, query_options)]:
+                    GerritApiCaller._cache_put(query, change_object,
+                                               replace=False)
+
+        changes = []
+        for change_id in change_ids:
+            change_id, _, patchset = change_id.partition('/')
+            matches = change_objects.get(change_id, [])
+            if len(matches) > 1:
+                raise Exception(
+                    "Unable to get a unique change for {}{}."
+                    "This can also happen if the same change-id is used "
+                    "in multiple gerrit projects.".format(
+                        change_id,
+                        " and branch {}".format(branch) if branch else ''))
+            elif not matches:
+                raise Exception("Unable to find a change for {}{}".format(
+                    change_id,
+                    " and branch {}".format(branch) if branch else ''))
+            elif branch and matches[0]['branch'] != branch:
+                raise Exception("Change {} does not target branch {}".format(
+                    change_id, branch))
+            changes.append(GerritChange(change_object=matches[0],
+                                        patchset=patchset or None))
+        return changes
+
     def _set_change_object(self, change_object):
         self._change_object = change_object
 
+    def _load_current_revision(self):
+        """
+        Reload the change object, including the current revision information
+        """
+        query = '/changes/{}/?{}'.format(self.id,
+                                         CURRENT_REVISION_QUERY_OPTIONS)
+        self._set_change_object(self._query_gerrit(query))
+        self._load_change_object()
+
     def _load_change_object(self, patchset=None):
         self.id = str(self._change_object['_number'])
         self.change_id = self._change_object['change_id']
         self.gerrit_project = self._change_object['project'].split('/')[1]
         self.status = self._change_object['status']
+        self.branch = self._change_object['branch']
+        if 'revisions' not in self._change_object:
+            # The revision attributes will be loaded on demand
+            return
         self.revision = self.current_revision = \
             self._change_object['current_revision']
         if patchset:
@@ -158,7 +671,6 @@ class GerritChange(GerritApiCaller):
         self.patchset = str(revision_obj['_number'])
         self.url = revision_obj['fetch']['anonymous http']['url']
         self.ref = revision_obj['fetch']['anonymous http']['ref']
-        self.branch = self._change_object['branch']
         self.subject = revision_obj['commit']['subject']
         self.commit_message = revision_obj['commit']['message']
         self.parent_revisions = [r['commit']
@@ -190,7 +702,7 @@ class GerritChange(GerritApiCaller):
                 self._dependency_headers.append(match[7])
         return self._dependency_headers
 
-    def _get_related_changes(self):
+    def _get_related_changes(self, concurrency=GERRIT_CONCURRENCY):
         """
         Get a list of GerritChange objects related to this change revision.
         Related changes are open changes that either depend on, or are
@@ -199,6 +711,8 @@ class GerritChange(GerritApiCaller):
         :return: A tuple consisting of two lists, the first with changes that
         have one or more revisions that depend on this revision, the second
         with changes on which this revision depends.
+
+        :param concurrency: maximum number of queries run concurrently
         """
 
         if self._related_changes is not None:
@@ -208,19 +722,23 @@ class GerritChange(GerritApiCaller):
                                                           self.patchset)
         response_json = self._query_gerrit(query)
 
-        current_list = references = []
-        dependencies = []
         # The /related result is ordered the same as a `git log` output,
         # it lists the entries ordered by their ancestry:
         #   - first, references (changes that depend on this one)
         #   - then, the current change, which we skip
         #   - then, implicit dependencies
-        for co in response_json['changes']:
-            if str(co['_change_number']) == self.id:
-                current_list = dependencies
-                continue
-            current_list.append(GerritChange(str(co['_change_number']),
-                                             patchset=co['_revision_number']))
+        related = [(str(co['_change_number']), co['_revision_number'])
+                   for co in response_json['changes']]
+        related_numbers = [change_number for change_number, _ in related]
+        current_idx = related_numbers.index(self.id) \
+            if self.id in related_numbers else len(related)
+        related_changes = GerritChange.get_changes(
+            ['{}/{}'.format(change_number, patchset)
+             for change_number, patchset in
+             related[:current_idx] + related[current_idx + 1:]],
+            concurrency=concurrency)
+        references = related_changes[:current_idx]
+        dependencies = related_changes[current_idx:]
 
         # The returned references may not all be direct descendants of this
         # revision. Some of them may reference earlier or older patchsets
@@ -260,33 +778,54 @@ class GerritChange(GerritApiCaller):
         references, _ = self._get_related_changes()
         return references
 
-    def _load_dependencies(self, loaded_deps):
-        for change in self.get_implicit_dependencies():
-            if change in loaded_deps:
-                continue
-            loaded_deps.append(change)
-        for change_id in self._find_dependency_headers():
-            change = GerritChange(change_id, self.branch)
-            if change in loaded_deps:
-                continue
-            loaded_deps.append(change)
+    def _get_direct_dependencies(self, concurrency=GERRIT_CONCURRENCY):
+        """
+        Get a list of GerritChange objects representing the direct implicit
+        dependencies, followed by the direct explicit dependencies of this
+        change.
+
+        :param concurrency: maximum number of queries run concurrently
+        """
+        explicit_dependencies = GerritChange.get_changes(
+            self._find_dependency_headers(), self.branch,
+            concurrency=concurrency)
+        _, implicit_dependencies = self._get_related_changes(concurrency)
+        return implicit_dependencies + explicit_dependencies
 
-    def get_dependencies(self):
+    def get_dependencies(self, concurrency=GERRIT_CONCURRENCY):
         """
         Walks the Depends-On dependency tree associated with this change and
         returns a list of unique GerritChange objects representing all
         direct and indirect dependencies.
 
+        The tree is walked breadth-first and the dependencies of all changes
+        on the same level are loaded concurrently.
+
+        :param concurrency: maximum number of changes loaded concurrently
         :return collected GerritChange objects
         """
 
         if self._dependencies is not None:
             return self._dependencies
 
-        self._dependencies = [self]
-        for change in self._dependencies:
-            change._load_dependencies(self._dependencies)
-        self._dependencies.pop(0)
+        dependencies = [self]
+        loaded = set(dependencies)
+        level = [self]
+        while level:
+            next_level = []
+            for direct_dependencies in concurrent_map(
+                    lambda change: change._get_direct_dependencies(
+                        concurrency),
+                    level, concurrency):
+                for change in direct_dependencies:
+                    if change in loaded:
+                        continue
+                    loaded.add(change)
+                    dependencies.append(change)
+                    next_level.append(change)
+            level = next_level
+        dependencies.pop(0)
+        self._dependencies = dependencies
         return self._dependencies
 
     def has_explicit_dependency(self, change):
@@ -314,20 +853,18 @@ class GerritChange(GerritApiCaller):
     def review(self, label=None, vote=1, message=''):
         print_err("Posting {} review for change: {}".format(
             " {}: {}".format(label, vote) if label else '', self))
-        auth = HTTPBasicAuthFromNetrc(url=GERRIT_URL)
-        rest = GerritRestAPI(url=GERRIT_URL, auth=auth, verify=GERRIT_VERIFY)
         rev = GerritReview()
         rev.set_message(message)
         if label:
             rev.add_labels({label: vote})
 
-        rest.review(self.id, self.patchset, rev)
+        self._rest_api().review(self.id, self.patchset, rev)
+        self._invalidate_change(self.id)
 
     def merge(self):
-        auth = HTTPBasicAuthFromNetrc(url=GERRIT_URL)
-        rest = GerritRestAPI(url=GERRIT_URL, auth=auth, verify=GERRIT_VERIFY)
         url_path = '/changes/{}/submit'.format(self.id)
-        rest.post(url_path)
+        self._rest_api().post(url_path)
+        self._invalidate_change(self.id)
 
     def __repr__(self):
         return "<GerritChange {}/{} ({}/{}): '{}'>".format(
@@ -352,9 +889,19 @@ class GerritChangeSet(GerritApiCaller):
         Get a set of change objects matching the supplied query
         """
         query = '/changes/?q={}'.format(query)
-        query += '&o=ALL_REVISIONS&o=ALL_COMMITS&o=SUBMITTABLE'
-        response_json = self._query_gerrit(query)
-        self._change_objects = response_json
+        query += '&' + CURRENT_REVISION_QUERY_OPTIONS
+        self._change_objects = []
+        while True:
+            page_query = query
+            if self._change_objects:
+                page_query += '&start={}'.format(len(self._change_objects))
+            response_json = self._query_gerrit(page_query)
+            self._change_objects.extend(response_json)
+            # Gerrit limits the number of changes returned by a query and
+            # flags the last change if more are available
+            if not response_json or \
+                    not response_json[-1].get('_more_changes'):
+                break
 
     def _load_changes(self):
         # FIXME: optimization - we might not need to load all changes into
@@ -366,3 +913,153 @@ class GerritChangeSet(GerritApiCaller):
 
     def changes(self):
         return self._changes
+
+
+class GerritReferenceIndex(GerritApiCaller):
+    """
+    Reverse index of the explicit dependencies (Depends-On) of all open
+    changes targeting a branch, mapping change numbers and Change-Id values
+    to the open changes referencing them.
+
+    The index is persisted on disk and re-used between runs. Every time it
+    is loaded, only the changes updated since the previous run are queried
+    and re-indexed. The index is rebuilt from scratch when it gets older
+    than MAX_AGE.
+    """
+
+    # How often (in seconds) the index is rebuilt from scratch
+    MAX_AGE = 24 * 3600
+    # Safety margin (in seconds) used when querying the changes updated
+    # since the index was last synchronized
+    SYNC_MARGIN = 300
+
+    def __init__(self, branch, cache_dir=GERRIT_CACHE_DIR):
+        self.branch = branch
+        self.path = os.path.join(
+            cache_dir,
+            'reference-index-{}.json'.format(branch.replace('/', '_')))
+        self._lock = threading.RLock()
+        self._change_objects = {}
+        self._dependency_ids = {}
+        self._index = {}
+        self._built = None
+        self._synced = None
+        self._load()
+        self.sync()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as index_file:
+                data = json.load(index_file)
+        except (IOError, OSError, ValueError) as e:
+            print_err("Ignoring unreadable reference index %s: %s" % (
+                self.path, e))
+            return
+        self._built = data['built']
+        self._synced = data['synced']
+        for change_object in data['changes'].values():
+            self._index_change_object(change_object)
+
+    def _save(self):
+        data = dict(built=self._built,
+                    synced=self._synced,
+                    changes=self._change_objects)
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'w') as index_file:
+                json.dump(data, index_file)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            print_err("Unable to save reference index %s: %s" % (
+                self.path, e))
+
+    def sync(self, min_interval=0):
+        """
+        Update the index with the changes updated since the last
+        synchronization, or rebuild it if it's too old.
+
+        :param min_interval: skip the synchronization if the index was
+        synchronized less than this many seconds ago
+        """
+        now = time.time()
+        with self._lock:
+            if self._synced is not None and \
+                    now - self._synced < min_interval:
+                return
+            if self._built is None or now - self._built > self.MAX_AGE:
+                print_err("Building reference index for branch %s" %
+                          self.branch)
+                changeset = GerritChangeSet(
+                    'is:open',
+                    'message:"Depends-On:"',
+                    'branch:{}'.format(self.branch))
+                self._change_objects = {}
+                self._dependency_ids = {}
+                self._index = {}
+                self._built = now
+            else:
+                # Closed changes and changes that no longer have explicit
+                # dependencies are also removed from the index
+                changeset = GerritChangeSet(
+                    'branch:{}'.format(self.branch),
+                    '-age:{}s'.format(
+                        int(now - self._synced) + self.SYNC_MARGIN))
+            for change in changeset.changes():
+                self.update_change(change, save=False)
+            self._synced = now
+            self._save()
+
+    def _index_change_object(self, change_object):
+        change = GerritChange(change_object=change_object)
+        dependency_ids = change._find_dependency_headers()
+        if change.status != 'NEW' or not dependency_ids:
+            return
+        # The revision information may have been loaded on demand
+        self._change_objects[change.id] = change._change_object
+        self._dependency_ids[change.id] = dependency_ids
+        for dependency_id in dependency_ids:
+            self._index.setdefault(dependency_id, set()).add(change.id)
+
+    def update_change(self, change, save=True):
+        """
+        Re-index a change that was updated (e.g. a new patchset was
+        published or it was merged or abandoned).
+
+        :param change: GerritChange object
+        :param save: persist the updated index
+        """
+        if change.branch != self.branch:
+            return
+        with self._lock:
+            self._change_objects.pop(change.id, None)
+            for dependency_id in self._dependency_ids.pop(change.id, []):
+                self._index.get(dependency_id, set()).discard(change.id)
+            self._index_change_object(change._change_object)
+            if save:
+                self._save()
+
+    def get_references(self, change):
+        """
+        Get the open changes that list the supplied change as an explicit
+        dependency, most recently updated first.
+
+        :param change: GerritChange object
+        :return: list of GerritChange objects
+        """
+        with self._lock:
+            numbers = self._index.get(change.id, set()) | \
+                self._index.get(change.change_id, set())
+            change_objects = [self._change_objects[number]
+                              for number in numbers]
+        # New GerritChange objects are returned every time, so that
+        # information loaded on demand (e.g. related changes) isn't reused
+        # between different events
+        return [GerritChange(change_object=change_object)
+                for change_object in sorted(
+                    change_objects,
+                    key=lambda co: (co.get('updated', ''), co['_number']),
+                    reverse=True)]
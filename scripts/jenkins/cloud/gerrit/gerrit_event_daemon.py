@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+"""
+Long-running service that consumes the Gerrit event stream and handles
+the same events as the openstack-ardana-gerrit-events Jenkins job, without
+spawning a new process for every event.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+sys.path.append(os.path.dirname(__file__))
+
+from gerrit import GERRIT_URL, GerritApiCaller, GerritChange, \
+    GerritReferenceIndex  # noqa: E402
+
+from gerrit_handle_event import handle_change_merged, \
+    handle_change_updated  # noqa: E402
+
+from gerrit_merge import gerrit_merge  # noqa: E402
+
+from gerrit_settings import gerrit_project_re  # noqa: E402
+
+# Comments that may affect the submittable state of a change
+MERGE_COMMENT_RE = re.compile(
+    r'Code-Review|Workflow|Verified|QE-Review|^reverify$', re.MULTILINE)
+
+# How often (in seconds) the reference indexes are synchronized with Gerrit,
+# to account for events that might have been missed
+REFERENCE_INDEX_SYNC_INTERVAL = 600
+
+
+def is_tracked_project(project, branch):
+    try:
+        return gerrit_project_re(branch).match(project) is not None
+    except KeyError:
+        return False
+
+
+def event_action(event):
+    """
+    Map a Gerrit stream event to the action that needs to be taken, if any.
+
+    :param event: Gerrit event object
+    :return: one of 'merged', 'updated' and 'merge' or None
+    """
+    change = event.get('change')
+    if not change or not is_tracked_project(change.get('project', ''),
+                                            change.get('branch', '')):
+        return None
+    if event['type'] == 'change-merged':
+        return 'merged'
+    if event['type'] == 'patchset-created':
+        if event.get('patchSet', {}).get('isDraft'):
+            return None
+        return 'updated'
+    if event['type'] == 'comment-added' and \
+            MERGE_COMMENT_RE.search(event.get('comment', '')):
+        return 'merge'
+    return None
+
+
+class EventDispatcher:
+    """
+    Dispatches the handling of Gerrit events to a bounded pool of worker
+    threads.
+
+    Events triggering the same action for the same change are coalesced if
+    they are received within the debounce interval, or while another action
+    is being handled for that change. Actions for the same change are never
+    handled concurrently.
+    """
+
+    def __init__(self, workers, debounce, dry_run=False):
+        self.debounce = debounce
+        self.dry_run = dry_run
+        self._pool = ThreadPool(workers)
+        self._cond = threading.Condition()
+        # Pending actions, as (change number, action) keys mapped to the
+        # time when they are due
+        self._pending = {}
+        # Numbers of the changes for which an action is being handled
+        self._running = set()
+        self._stopped = False
+        self._reference_indexes = {}
+        # Query responses cached in memory are shared by the events handled
+        # concurrently, until they expire
+        GerritApiCaller.enable_cache_expiry()
+        self._scheduler = threading.Thread(target=self._schedule)
+        self._scheduler.daemon = True
+        self._scheduler.start()
+
+    def submit(self, change_number, action):
+        key = (str(change_number), action)
+        with self._cond:
+            if key in self._pending:
+                print("Coalescing {} event for change {}".format(
+                    action, change_number))
+                return
+            self._pending[key] = time.time() + self.debounce
+            self._cond.notify()
+
+    def stop(self, flush=False):
+        """
+        Stop the dispatcher and wait for the pending actions to complete.
+
+        :param flush: handle pending actions right away, without waiting for
+        the debounce interval to expire
+        """
+        with self._cond:
+            self._stopped = True
+            if flush:
+                for key in self._pending:
+                    self._pending[key] = 0
+            self._cond.notify()
+        self._scheduler.join()
+        self._pool.close()
+        self._pool.join()
+
+    def _schedule(self):
+        with self._cond:
+            while not self._stopped or self._pending or self._running:
+                now = time.time()
+                timeout = None
+                # Actions pending for the same change are handled in the
+                # order in which they are due, one at a time
+                for key, due in sorted(self._pending.items(),
+                                       key=lambda item: item[1]):
+                    change_number = key[0]
+                    if change_number in self._running:
+                        continue
+                    if due <= now:
+                        del self._pending[key]
+                        self._running.add(change_number)
+                        self._pool.apply_async(self._handle, key)
+                    elif timeout is None or due - now < timeout:
+                        timeout = max(due - now, 0.1)
+                self._cond.wait(timeout)
+
+    def _reference_index(self, branch):
+        with self._cond:
+            if branch not in self._reference_indexes:
+                self._reference_indexes[branch] = \
+                    GerritReferenceIndex(branch)
+            reference_index = self._reference_indexes[branch]
+        reference_index.sync(min_interval=REFERENCE_INDEX_SYNC_INTERVAL)
+        return reference_index
+
+    def _handle(self, change_number, action):
+        try:
+            GerritApiCaller.purge_expired_cache()
+            change = GerritChange(change_number, refresh=True)
+            if action == 'merged':
+                self._reference_index(change.branch).update_change(change)
+                handle_change_merged(change, self.dry_run)
+            elif action == 'updated':
+                handle_change_updated(
+                    change, self.dry_run,
+                    reference_index=self._reference_index(change.branch))
+            elif action == 'merge':
+                gerrit_merge(change, self.dry_run)
+        except Exception as e:
+            print("Failed to handle {} event for change {}: {}".format(
+                action, change_number, e))
+        finally:
+            with self._cond:
+                self._running.discard(change_number)
+                self._cond.notify()
+
+
+def ssh_event_stream(user, host, port):
+    """
+    Yield events from the Gerrit SSH event stream, reconnecting if the
+    connection is lost.
+    """
+    retry_delay = 1
+    while True:
+        print("Connecting to the Gerrit event stream on {}".format(host))
+        proc = subprocess.Popen(
+            ['ssh', '-p', str(port), '-o', 'ServerAliveInterval=30',
+             '{}@{}'.format(user, host), 'gerrit', 'stream-events'],
+            stdout=subprocess.PIPE)
+        for line in iter(proc.stdout.readline, b''):
+            retry_delay = 1
+            yield line.decode('utf-8')
+        proc.wait()
+        print("Gerrit event stream closed (exit code {}), reconnecting "
+              "in {}s".format(proc.returncode, retry_delay))
+        time.sleep(retry_delay)
+        retry_delay = min(retry_delay * 2, 60)
+
+
+def file_event_stream(path):
+    """
+    Yield events recorded in a file, one JSON event per line.
+    """
+    events_file = sys.stdin if path == '-' else open(path)
+    try:
+        for line in events_file:
+            yield line
+    finally:
+        if events_file is not sys.stdin:
+            events_file.close()
+
+
+def dispatch_events(dispatcher, events):
+    """
+    Submit the actions required by a stream of Gerrit events to a
+    dispatcher.
+
+    :param dispatcher: EventDispatcher instance
+    :param events: iterable of JSON encoded Gerrit events
+    """
+    for line in events:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            print("Ignoring invalid event: {}".format(line))
+            continue
+        action = event_action(event)
+        if action:
+            dispatcher.submit(event['change']['number'], action)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Handle Gerrit events continuously, as they are '
+                    'reported by the Gerrit event stream')
+    parser.add_argument('--events-file', default=None,
+                        help='replay the events recorded in a file (one '
+                             'JSON event per line, - for stdin) instead of '
+                             'connecting to the Gerrit event stream')
+    parser.add_argument('--ssh-user', default=os.environ.get('USER'),
+                        help='the user used to connect to the Gerrit SSH '
+                             'event stream')
+    parser.add_argument('--ssh-port', type=int, default=29418,
+                        help='the Gerrit SSH port')
+    parser.add_argument('--debounce', type=float, default=30,
+                        help='interval (in seconds) during which events '
+                             'for the same change are coalesced')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='maximum number of events handled '
+                             'concurrently')
+    parser.add_argument('--dry-run', default=False, action='store_true',
+                        help='do a dry run')
+
+    args = parser.parse_args()
+
+    if args.events_file:
+        events = file_event_stream(args.events_file)
+    else:
+        events = ssh_event_stream(args.ssh_user,
+                                  GERRIT_URL.split('://')[-1],
+                                  args.ssh_port)
+
+    dispatcher = EventDispatcher(args.workers, args.debounce, args.dry_run)
+    try:
+        dispatch_events(dispatcher, events)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dispatcher.stop(flush=bool(args.events_file))
+
+
+if __name__ == '__main__':
+    main()
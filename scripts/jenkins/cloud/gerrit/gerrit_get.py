@@ -22,7 +22,7 @@ def main():
 
     args = parser.parse_args()
 
-    change = GerritChange(args.change)
+    change = GerritChange(args.change, refresh=True)
     print(getattr(change, args.attr))
 
 
@@ -6,11 +6,12 @@ import sys
 
 sys.path.append(os.path.dirname(__file__))
 
-from gerrit import GerritChange, GerritChangeSet  # noqa: E402
+from gerrit import GerritChange, GerritChangeSet, \
+    GerritReferenceIndex  # noqa: E402
 
-from gerrit_merge import gerrit_merge  # noqa: E402
+from gerrit_merge import merge_changes  # noqa: E402
 
-from gerrit_review import gerrit_review  # noqa: E402
+from gerrit_review import gerrit_review_changes  # noqa: E402
 
 
 def get_submittable_references(change):
@@ -52,7 +53,7 @@ def get_submittable_references(change):
     return references
 
 
-def get_stale_references(change):
+def get_stale_references(change, reference_index=None):
     """
     Get all changes that directly or indirectly explicitly or implicitly
     depend on the indicated updated Gerrit change and targeting the same
@@ -61,21 +62,19 @@ def get_stale_references(change):
 
     :param change: GerritChange object representing a change
     that has been updated (e.g. for which a new patchset was published)
+    :param reference_index: GerritReferenceIndex object for the change
+    target branch (loaded and synchronized if not supplied)
     :return: list of GerritChange object representing changes directly or
     indirectly referencing the supplied change as an explicit dependency
     """
-    explicit_changeset = GerritChangeSet(
-        'is:open',
-        'message:"Depends-On:"',
-        'branch:{}'.format(change.branch)
-    )
+    if reference_index is None:
+        reference_index = GerritReferenceIndex(change.branch)
 
     # All open changes in the dependency tree will be added to this list
     stale_references = [change]
     for stale_change in stale_references:
-        for open_change in explicit_changeset.changes():
-            if (open_change not in stale_references and
-               open_change.has_explicit_dependency(stale_change)):
+        for open_change in reference_index.get_references(stale_change):
+            if open_change not in stale_references:
                 stale_references.append(open_change)
         # We ignore current ancestors of the input change because the
         # only way they can be current is if they were uploaded at the same
@@ -119,13 +118,14 @@ def handle_change_merged(change, dry_run=False):
     print("Attempting to merge related changes:\n{}".format('\n'.join([
             str(c) for c in references])))
 
-    for ref_change in references:
-        gerrit_merge(ref_change, dry_run)
+    results = merge_changes(references, dry_run)
+    print("Merge results:\n{}".format('\n'.join([
+        '{}: {}'.format(c, results[c.id]) for c in references])))
 
     return 0
 
 
-def handle_change_updated(change, dry_run=False):
+def handle_change_updated(change, dry_run=False, reference_index=None):
     """
     When a new patchset is published for a Gerrit change, track down all the
     other open changes that list the updated change as an explicit dependency
@@ -138,6 +138,8 @@ def handle_change_updated(change, dry_run=False):
 
     :param change: GerritChange object
     :param dry_run:
+    :param reference_index: GerritReferenceIndex object for the change
+    target branch (loaded and synchronized if not supplied)
     :return:
     """
 
@@ -152,7 +154,13 @@ def handle_change_updated(change, dry_run=False):
             change.status.lower(), change))
         return 0
 
-    references = get_stale_references(change)
+    if reference_index is None:
+        reference_index = GerritReferenceIndex(change.branch)
+    # The updated change may have added or removed explicit dependencies.
+    # The on-disk index is left untouched for dry runs.
+    reference_index.update_change(change, save=not dry_run)
+
+    references = get_stale_references(change, reference_index)
     if not references:
         print("Nothing to do")
         return 0
@@ -161,16 +169,18 @@ def handle_change_updated(change, dry_run=False):
         print("Invalidating related changes:\n{}".format('\n'.join([
                 str(c) for c in references])))
 
+        reviews = []
         for ref_change in references:
             direct = ref_change.has_explicit_dependency(change)
-            gerrit_review(ref_change, label='Verified', vote=0,
-                          message='Needs recheck. New patchset {} was '
-                                  'published for {}direct dependency: '
-                                  '{} '.format(
-                                    change.patchset,
-                                    '' if direct else 'in',
-                                    change.gerrit_url)
-                          )
+            reviews.append((ref_change, 'Verified', 0,
+                            'Needs recheck. New patchset {} was '
+                            'published for {}direct dependency: '
+                            '{} '.format(change.patchset,
+                                         '' if direct else 'in',
+                                         change.gerrit_url)))
+        results = gerrit_review_changes(reviews)
+        if 'failed' in results.values():
+            return 1
     else:
         print("[DRY-RUN] Invalidated changes:\n{}".format('\n'.join([
                 str(c) for c in references])))
@@ -195,7 +205,8 @@ def main():
 
     args = parser.parse_args()
 
-    change = GerritChange(str(args.change), patchset=args.patch)
+    change = GerritChange(str(args.change), patchset=args.patch,
+                          refresh=True)
 
     if args.event == 'merged':
         handle_change_merged(change, args.dry_run)
@@ -6,16 +6,29 @@ import sys
 
 sys.path.append(os.path.dirname(__file__))
 
-from gerrit import GerritChange  # noqa: E402
+from gerrit import GERRIT_CONCURRENCY, GerritChange, \
+    concurrent_map  # noqa: E402
 
 from gerrit_settings import gerrit_project_map  # noqa: E402
 
 
-def check_all_dependencies_satisfied(change):
-    change_deps = change.get_dependencies()
+def check_all_dependencies_satisfied(change, dependencies=None, merged=()):
+    """
+    Check that all dependencies of a Gerrit change are merged.
+
+    :param change: GerritChange object
+    :param dependencies: list of GerritChange objects representing all
+    dependencies of the change (computed if not supplied)
+    :param merged: collection of numbers of changes known to have been
+    merged since the dependencies were computed
+    :return: True if all dependencies are merged, False otherwise
+    """
+    if dependencies is None:
+        dependencies = change.get_dependencies()
     unmerged_deps = [change_dep
-                     for change_dep in change_deps
-                     if change_dep.status != "MERGED"]
+                     for change_dep in dependencies
+                     if change_dep.status != "MERGED" and
+                     change_dep.id not in merged]
 
     if unmerged_deps:
         print("Unmerged dependencies:\n{}".format('\n'.join([
@@ -25,12 +38,16 @@ def check_all_dependencies_satisfied(change):
     return True
 
 
-def gerrit_merge(change, dry_run=False):
+def gerrit_merge(change, dry_run=False, dependencies=None, merged=()):
     """
     Attempt to merge a Gerrit change.
 
     :param change:
     :param dry_run:
+    :param dependencies: list of GerritChange objects representing all
+    dependencies of the change (computed if not supplied)
+    :param merged: collection of numbers of changes known to have been
+    merged since the dependencies were computed
     :return:
     """
     project_map = gerrit_project_map(change.branch)
@@ -59,7 +76,7 @@ def gerrit_merge(change, dry_run=False):
         print("Change doesn't meet submit requirements: {}".format(change))
         return 1
 
-    if not check_all_dependencies_satisfied(change):
+    if not check_all_dependencies_satisfied(change, dependencies, merged):
         msg = "Unable to merge: Commit dependencies are not satisifed."
         print(msg)
         if not dry_run:
@@ -75,6 +92,80 @@ def gerrit_merge(change, dry_run=False):
     return 0
 
 
+def merge_changes(changes, dry_run=False, concurrency=GERRIT_CONCURRENCY):
+    """
+    Attempt to merge a set of Gerrit changes, in dependency order.
+
+    The dependencies of all changes are computed only once. Changes that
+    depend on other changes in the set are only merged after the latter,
+    while changes that don't depend on each other are merged concurrently.
+    Changes depending on a change that could not be merged are not
+    attempted at all.
+
+    :param changes: list of GerritChange objects
+    :param dry_run:
+    :param concurrency: maximum number of changes merged concurrently
+    :return: dictionary mapping the numbers of the supplied changes to
+    their merge result: 'merged', 'failed' or 'blocked'
+    """
+    changes = [change for i, change in enumerate(changes)
+               if change not in changes[:i]]
+    dependencies = dict(zip(
+        [change.id for change in changes],
+        concurrent_map(lambda change: change.get_dependencies(concurrency),
+                       changes, concurrency)))
+    # Dependencies on changes from the same set
+    pending = dict(
+        (change.id, set([dep.id for dep in dependencies[change.id]
+                         if dep in changes and dep != change]))
+        for change in changes)
+
+    results = {}
+    merged = set()
+    while pending:
+        wave = [change for change in changes
+                if change.id in pending and
+                pending[change.id].issubset(results)]
+        if not wave:
+            # Circular dependencies
+            for change_id in pending:
+                print("Skipping - circular dependencies: {}".format(
+                    change_id))
+                results[change_id] = 'blocked'
+            break
+        candidates = []
+        for change in wave:
+            blocking = [dep for dep in pending.pop(change.id)
+                        if results[dep] != 'merged']
+            if blocking:
+                print("Skipping - dependencies could not be merged: "
+                      "{}".format(change))
+                results[change.id] = 'blocked'
+            else:
+                candidates.append(change)
+        # Merged dependencies are only accounted for between waves
+        merged_deps = frozenset(merged)
+
+        def merge_change(change):
+            try:
+                return gerrit_merge(change, dry_run,
+                                    dependencies[change.id], merged_deps)
+            except Exception as e:
+                # Gerrit may still reject the change (e.g. with a conflict)
+                print("Failed to merge change {}: {}".format(change, e))
+                return 1
+
+        outcomes = concurrent_map(merge_change, candidates, concurrency)
+        for change, outcome in zip(candidates, outcomes):
+            if outcome == 0:
+                results[change.id] = 'merged'
+                merged.add(change.id)
+            else:
+                results[change.id] = 'failed'
+
+    return results
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Merge a Gerrit change if its dependencies have merged '
@@ -90,7 +181,8 @@ def main():
 
     args = parser.parse_args()
 
-    change = GerritChange(str(args.change), patchset=args.patch)
+    change = GerritChange(str(args.change), patchset=args.patch,
+                          refresh=True)
 
     gerrit_merge(change, args.dry_run)
 
@@ -3,13 +3,44 @@
 import argparse
 import os
 import sys
+import threading
+import time
 
 sys.path.append(os.path.dirname(__file__))
 
-from gerrit import GerritChange  # noqa: E402
+from gerrit import GerritChange, concurrent_map  # noqa: E402
 
 from gerrit_settings import gerrit_project_map  # noqa: E402
 
+import requests  # noqa: E402
+
+# Maximum number of reviews posted concurrently by gerrit_review_changes
+GERRIT_REVIEW_CONCURRENCY = int(os.environ.get('GERRIT_REVIEW_CONCURRENCY',
+                                               4))
+# Maximum number of reviews posted per second by gerrit_review_changes
+# (0 means no limit)
+GERRIT_REVIEW_RATE = float(os.environ.get('GERRIT_REVIEW_RATE', 5))
+
+
+class RateLimiter(object):
+    """
+    Spaces out operations performed by several threads, to keep their
+    rate below a given number of operations per second.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
 
 def gerrit_review(change, label=None, vote=1, message=''):
     if change.gerrit_project not in gerrit_project_map(change.branch):
@@ -26,6 +57,45 @@ def gerrit_review(change, label=None, vote=1, message=''):
     return 0
 
 
+def gerrit_review_changes(reviews, concurrency=GERRIT_REVIEW_CONCURRENCY,
+                          rate=GERRIT_REVIEW_RATE):
+    """
+    Post reviews for several Gerrit changes, concurrently.
+
+    Posting a review is not idempotent, so failed reviews are not retried
+    here. The shared Gerrit HTTP session already retries the requests that
+    could not be sent at all, because the connection to Gerrit could not
+    be established.
+
+    :param reviews: list of (change, label, vote, message) tuples, with the
+    same meaning as the gerrit_review arguments
+    :param concurrency: maximum number of reviews posted concurrently
+    :param rate: maximum number of reviews posted per second
+    :return: dictionary mapping change numbers to their review result:
+    'posted', 'skipped' or 'failed'
+    """
+    rate_limiter = RateLimiter(rate)
+
+    def post_review(review):
+        rate_limiter.wait()
+        try:
+            if gerrit_review(*review) == 0:
+                return 'posted'
+            return 'skipped'
+        except requests.RequestException as e:
+            print("Failed to post review for change {}: {}".format(
+                review[0], e))
+            return 'failed'
+
+    results = concurrent_map(post_review, reviews, concurrency)
+    results = dict(zip([review[0].id for review in reviews], results))
+
+    print("Reviews posted: {}, skipped: {}, failed: {}".format(*[
+        list(results.values()).count(result)
+        for result in ['posted', 'skipped', 'failed']]))
+    return results
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Post a Gerrit review')
@@ -59,7 +129,8 @@ def main():
         with open(args.message_file) as msg_file:
             message += msg_file.read()
 
-    change = GerritChange(str(args.change), patchset=args.patch)
+    change = GerritChange(str(args.change), patchset=args.patch,
+                          refresh=True)
 
     gerrit_review(change,
                   args.label,
@@ -1,18 +1,73 @@
 import json
 import os
+import re
+import threading
+
+GERRIT_SETTINGS_FILE = os.path.join(os.path.dirname(__file__),
+                                    'gerrit-settings.json')
+
+# The parsed settings are cached and only reloaded when the settings file
+# is modified. The lookup structures derived from the settings are computed
+# on demand, per branch, and reset every time the settings are reloaded.
+_SETTINGS_CACHE = {'mtime': None, 'settings': None, 'lookups': {}}
+_SETTINGS_LOCK = threading.Lock()
 
 
 def gerrit_settings():
-    settings_filepath = os.path.join(os.path.dirname(__file__),
-                                     'gerrit-settings.json')
-    with open(settings_filepath) as settings_file:
-        settings = json.load(settings_file)
-    return settings
+    """
+    Get the contents of the gerrit-settings.json file.
+
+    The returned object is shared between callers and must not be modified.
+    """
+    mtime = os.stat(GERRIT_SETTINGS_FILE).st_mtime
+    with _SETTINGS_LOCK:
+        if _SETTINGS_CACHE['mtime'] != mtime:
+            with open(GERRIT_SETTINGS_FILE) as settings_file:
+                _SETTINGS_CACHE['settings'] = json.load(settings_file)
+            _SETTINGS_CACHE['mtime'] = mtime
+            _SETTINGS_CACHE['lookups'] = {}
+        return _SETTINGS_CACHE['settings']
+
+
+def _branch_lookups(branch):
+    settings = gerrit_settings()
+    with _SETTINGS_LOCK:
+        lookups = _SETTINGS_CACHE['lookups'].get(branch)
+        if lookups is None:
+            project_map = settings[branch]['project-map']
+            lookups = {
+                'project-regexp': '({})'.format('|'.join(
+                    'ardana/' + project for project in project_map)),
+                'project-re': re.compile(r'^ardana/({})$'.format('|'.join(
+                    re.escape(project) for project in project_map))),
+            }
+            _SETTINGS_CACHE['lookups'][branch] = lookups
+        return lookups
 
 
 def gerrit_project_map(branch):
+    """
+    Get the Gerrit project (without the 'ardana/' prefix) to OBS package
+    name map for a branch.
+    """
     return gerrit_settings()[branch]['project-map']
 
 
+def gerrit_project_regexp(branch):
+    """
+    Get a regular expression string matching the full names of all Gerrit
+    projects mapped for a branch, e.g. '(ardana/ardana-ansible|...)'.
+    """
+    return _branch_lookups(branch)['project-regexp']
+
+
+def gerrit_project_re(branch):
+    """
+    Get a compiled regular expression matching exactly the full names of
+    all Gerrit projects mapped for a branch.
+    """
+    return _branch_lookups(branch)['project-re']
+
+
 def obs_project_settings(branch):
     return gerrit_settings()[branch]['obs-project']
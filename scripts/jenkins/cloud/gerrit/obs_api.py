@@ -0,0 +1,142 @@
+"""
+Minimal in-process client for the read-only parts of the OBS API (package
+metadata, file contents, package listings and build results), used instead
+of spawning an osc process for every call. Operations that depend on the
+state of a local osc checkout are still performed with osc.
+"""
+
+import os
+import sys
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+if sys.version_info[0] < 3:
+    from ConfigParser import SafeConfigParser as ConfigParser
+    from urllib import quote
+else:
+    from configparser import ConfigParser
+    from urllib.parse import quote
+
+try:
+    from xml.etree import cElementTree as ET
+except ImportError:
+    import cElementTree as ET
+
+OBS_API_URL = os.environ.get('OBS_API_URL', 'https://api.suse.de')
+
+# All OBS API calls share a pool of persistent HTTP connections
+OBS_POOL_SIZE = int(os.environ.get('OBS_POOL_SIZE', 10))
+OBS_RETRIES = int(os.environ.get('OBS_RETRIES', 5))
+OBS_TIMEOUT = float(os.environ.get('OBS_TIMEOUT', 60))
+
+OSCRC_PATHS = [
+    os.path.join(os.path.expanduser('~'), '.config', 'osc', 'oscrc'),
+    os.path.join(os.path.expanduser('~'), '.oscrc'),
+]
+
+
+def osc_credentials(apiurl):
+    """
+    Get the credentials configured for an OBS API URL in the osc
+    configuration.
+
+    The osc library is used to read the configuration, if available, to
+    support all the credentials managers it implements. Otherwise, plain
+    text credentials are read directly from the oscrc file.
+
+    :return: (user, password) tuple, or None if no credentials are found
+    """
+    try:
+        import osc.conf
+        osc.conf.get_config(override_apiurl=apiurl)
+        host_options = osc.conf.config['api_host_options'][
+            osc.conf.config['apiurl']]
+        return host_options['user'], host_options['pass']
+    except Exception:
+        pass
+
+    parser = ConfigParser()
+    parser.read(OSCRC_PATHS)
+    for section in [apiurl, apiurl.rstrip('/') + '/']:
+        if parser.has_section(section) and \
+                parser.has_option(section, 'user') and \
+                parser.has_option(section, 'pass'):
+            return (parser.get(section, 'user', raw=True),
+                    parser.get(section, 'pass', raw=True))
+    return None
+
+
+class OBSApi(object):
+    """
+    OBS API client, sharing an authenticated pool of persistent HTTP
+    connections between all calls.
+    """
+
+    def __init__(self, apiurl=OBS_API_URL, auth=None):
+        self.apiurl = apiurl.rstrip('/')
+        self.session = requests.Session()
+        retry = Retry(total=OBS_RETRIES, backoff_factor=0.5,
+                      status_forcelist=(500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=OBS_POOL_SIZE,
+                              max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.auth = auth if auth is not None \
+            else osc_credentials(self.apiurl)
+
+    def get(self, path, **params):
+        """
+        Issue a GET request for an OBS API path.
+
+        :return: the response body
+        """
+        response = self.session.get(self.apiurl + path, params=params,
+                                    timeout=OBS_TIMEOUT)
+        response.raise_for_status()
+        return response.text
+
+    @staticmethod
+    def _source_path(*names):
+        return '/source/' + '/'.join(quote(name, safe=':') for name in names)
+
+    def cat(self, project, package, filename, expand=True):
+        """
+        Get the contents of a package source file (like 'osc cat').
+
+        :param expand: expand source links
+        """
+        params = {'expand': 1} if expand else {}
+        return self.get(self._source_path(project, package, filename),
+                        **params)
+
+    def meta(self, project, package=None):
+        """
+        Get the metadata of a project or package (like 'osc meta').
+        """
+        names = [project, package] if package else [project]
+        return self.get(self._source_path(*names) + '/_meta')
+
+    def list_packages(self, project, expand=False):
+        """
+        Get the names of the packages in a project (like 'osc ls').
+
+        :param expand: include packages inherited from linked projects
+        """
+        params = {'expand': 1} if expand else {}
+        directory = ET.fromstring(self.get(self._source_path(project),
+                                           **params).encode('utf-8'))
+        return [entry.get('name') for entry in directory.findall('entry')]
+
+    def build_results(self, project, **filters):
+        """
+        Get the build results of all packages in a project, as XML (like
+        'osc results').
+
+        :param filters: optional result filters (e.g. package, repository,
+        arch)
+        """
+        return self.get('/build/%s/_result' % quote(project, safe=':'),
+                        **filters)
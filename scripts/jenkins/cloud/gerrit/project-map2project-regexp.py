@@ -5,19 +5,11 @@ import os
 import sys
 
 sys.path.append(os.path.dirname(__file__))
-from gerrit_settings import gerrit_project_map  # noqa: E402
+from gerrit_settings import gerrit_project_regexp  # noqa: E402
 
 
 def main():
-    print('(', end='')
-    first = True
-    for project in gerrit_project_map(sys.argv[1]):
-        if first:
-            first = False
-        else:
-            print('|', end='')
-        print('ardana/'+project, end='')
-    print(')', end='')
+    print(gerrit_project_regexp(sys.argv[1]), end='')
 
 
 if __name__ == '__main__':
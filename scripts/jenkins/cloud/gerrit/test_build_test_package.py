@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+import unittest
+
+import build_test_package
+
+
+class FakeTime(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakePackage(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeOBSProject(build_test_package.OBSProject):
+
+    def __init__(self, packages):
+        self.packages = set(FakePackage(name) for name in packages)
+
+
+class TestWaitForAllResults(unittest.TestCase):
+
+    def setUp(self):
+        self._time = build_test_package.time
+        build_test_package.time = FakeTime()
+        self.project = FakeOBSProject(['a', 'b'])
+        # Build results returned by every poll, the last one is repeated
+        self.results = []
+        self.project.get_build_results = self.get_build_results
+        self.polls = 0
+
+    def tearDown(self):
+        build_test_package.time = self._time
+
+    def get_build_results(self):
+        self.polls += 1
+        return self.results[min(self.polls, len(self.results)) - 1]
+
+    def test_succeeded(self):
+        self.results = [
+            {'a': ['succeeded'], 'b': ['unknown']},
+            {'b': ['building', 'succeeded']},
+            {'b': ['succeeded', 'succeeded']},
+        ]
+        self.assertTrue(self.project.wait_for_all_results(
+            poll_interval=1))
+        self.assertEqual(self.polls, 3)
+
+    def test_missing(self):
+        self.results = [{'a': ['succeeded']}]
+        self.assertFalse(self.project.wait_for_all_results(
+            poll_interval=1, missing_polls=3))
+        self.assertEqual(self.polls, 3)
+
+    def test_timeout(self):
+        self.results = [{'a': ['succeeded'], 'b': ['scheduled']}]
+        self.assertFalse(self.project.wait_for_all_results(
+            poll_interval=10, timeout=60))
+        self.assertEqual(self.polls, 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
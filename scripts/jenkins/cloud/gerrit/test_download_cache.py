@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import unittest
+
+import download_cache
+
+
+SPEC = """
+%global sname oslo.config
+Name:           python-oslo.config
+Version:        6.8.1
+Release:        0
+Source0:        https://files.pythonhosted.org/packages/source/o/%{sname}/%{sname}-%{version}.tar.gz
+Source1:        https://example.com/%{unknown}/file.tar.gz
+Source2:        local.tar.gz
+"""  # noqa: E501
+
+
+class TestDownloadCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = download_cache.DownloadCache(
+            os.path.join(self.tmp_dir, 'cache'), max_size=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def download(self, url, contents):
+        """Store a file in the cache the same way download_files does"""
+        key = download_cache.url_key(url)
+        with open(os.path.join(self.cache.file_dir, key), 'w') as f:
+            f.write(contents)
+        with open(os.path.join(self.cache.filename_dir, key), 'w') as f:
+            f.write(download_cache.url_filename(url) + '\n')
+        return os.path.join(self.cache.file_dir, key)
+
+    def test_spec_source_urls(self):
+        spec_path = os.path.join(self.tmp_dir, 'test.spec')
+        with open(spec_path, 'w') as spec_file:
+            spec_file.write(SPEC)
+        self.assertEqual(
+            download_cache.spec_source_urls(spec_path),
+            ['https://files.pythonhosted.org/packages/source/o/oslo.config/'
+             'oslo.config-6.8.1.tar.gz'])
+
+    def test_url_filename(self):
+        self.assertEqual(
+            download_cache.url_filename('https://x.org/a/b-1.0.tar.gz'),
+            'b-1.0.tar.gz')
+        self.assertEqual(
+            download_cache.url_filename('https://x.org/a/v1.0#/b-1.0.tgz'),
+            'b-1.0.tgz')
+
+    def test_ingest_dedup(self):
+        path1 = self.download('https://a.org/x-1.0.tar.gz', 'x' * 10)
+        path2 = self.download('https://b.org/y-1.0.tar.gz', 'x' * 10)
+        self.assertEqual(self.cache.ingest(), 2)
+        # The contents are stored once
+        self.assertTrue(os.path.samefile(path1, path2))
+        self.assertEqual(len(os.listdir(self.cache.objects_dir)), 1)
+        self.assertEqual(self.cache.ingest(), 0)
+
+    def test_prepare_moved_url(self):
+        self.download('https://a.org/x-1.0.tar.gz', 'x' * 10)
+        self.cache.ingest()
+        moved_url = 'https://b.org/mirror/x-1.0.tar.gz'
+        self.assertEqual(self.cache.prepare(
+            [moved_url, 'https://a.org/z-1.0.tar.gz']), 1)
+        with open(os.path.join(self.cache.file_dir,
+                               download_cache.url_key(moved_url))) as f:
+            self.assertEqual(f.read(), 'x' * 10)
+        # Ambiguous file names are not served from the object store
+        self.download('https://c.org/x-1.0.tar.gz', 'y' * 10)
+        self.cache.ingest()
+        self.assertEqual(self.cache.prepare(
+            ['https://d.org/x-1.0.tar.gz']), 0)
+
+    def test_evict(self):
+        self.download('https://a.org/x-1.0.tar.gz', 'x' * 60)
+        self.download('https://b.org/x-1.0.tar.gz', 'x' * 60)
+        self.cache.ingest()
+        # Objects stored once are only accounted for once
+        self.assertEqual(self.cache.evict(), 0)
+        self.download('https://a.org/y-1.0.tar.gz', 'y' * 60)
+        self.cache.update()
+        self.assertEqual(len(os.listdir(self.cache.objects_dir)), 1)
+        self.assertEqual(len(os.listdir(self.cache.file_dir)), 1)
+
+    def test_update_while_downloading(self):
+        self.download('https://a.org/x-1.0.tar.gz', 'x' * 10)
+        with self.cache.downloading():
+            self.cache.update()
+        self.assertEqual(os.listdir(self.cache.objects_dir), [])
+        self.cache.update()
+        self.assertEqual(len(os.listdir(self.cache.objects_dir)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
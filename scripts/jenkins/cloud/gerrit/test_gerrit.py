@@ -0,0 +1,528 @@
+#!/usr/bin/env python
+import shutil
+import tempfile
+import unittest
+
+import gerrit
+
+import gerrit_merge
+
+import gerrit_review
+
+
+def change_object(number, updated):
+    return {'_number': number, 'updated': updated}
+
+
+def project_change_object(co, query):
+    """
+    Remove the change object fields not requested by the query options
+    """
+    if 'o=' in query:
+        return co
+    return dict([(key, value) for key, value in co.items()
+                 if key not in ['revisions', 'current_revision',
+                                'submittable']])
+
+
+class FakeResponse(object):
+
+    def __init__(self, result):
+        self.ok = True
+        self.text = ")]}'" + gerrit.json.dumps(result)
+
+
+class FakeGerrit(object):
+    """
+    Minimal stand-in for the Gerrit REST API, serving a set of changes
+    forming a single git history (implicit dependencies) per project.
+    """
+
+    def __init__(self):
+        self.changes = {}
+        self.parents = {}
+        self.queries = []
+        # Maximum number of changes returned by a query, if set
+        self.page_size = None
+
+    def add_change(self, number, project='ardana/project', parent=None,
+                   depends_on=(), status='NEW'):
+        revision = 'rev{}'.format(number)
+        message = 'Change {}\n\n'.format(number) + ''.join(
+            'Depends-On: {}\n'.format(dep) for dep in depends_on)
+        self.parents[number] = parent
+        self.changes[number] = {
+            '_number': number,
+            'change_id': 'I{:040x}'.format(number),
+            'project': project,
+            'branch': 'master',
+            'status': status,
+            'updated': '2019-01-01 00:00:00',
+            'current_revision': revision,
+            'submittable': False,
+            'revisions': {
+                revision: {
+                    '_number': 1,
+                    'fetch': {'anonymous http': {
+                        'url': 'https://gerrit/' + project,
+                        'ref': 'refs/changes/{}/1'.format(number)}},
+                    'commit': {
+                        'subject': 'Change {}'.format(number),
+                        'message': message,
+                        'parents': [{'commit': 'rev{}'.format(parent)
+                                     if parent else 'base'}]}
+                }
+            }
+        }
+
+    def _related(self, number):
+        ancestors = []
+        parent = self.parents[number]
+        while parent:
+            ancestors.append(parent)
+            parent = self.parents[parent]
+        descendants = []
+        children = [number]
+        while children:
+            children = [n for n, p in self.parents.items()
+                        if p in children]
+            descendants = children + descendants
+        chain = descendants + [number] + ancestors
+        if len(chain) == 1:
+            return []
+        return [{'_change_number': n, '_revision_number': 1} for n in chain]
+
+    @staticmethod
+    def _matches(co, conditions):
+        message = co['revisions'][co['current_revision']]['commit']['message']
+        for operator, value in conditions.items():
+            if operator == 'change' and value not in [str(co['_number']),
+                                                      co['change_id']]:
+                return False
+            if operator == 'branch' and value != co['branch']:
+                return False
+            if operator == 'is' and co['status'] != 'NEW':
+                return False
+            if operator == 'message' and value.strip('"') not in message:
+                return False
+        return True
+
+    def get(self, url, **kwargs):
+        query = url[len(gerrit.GERRIT_URL):]
+        self.queries.append(query)
+        match = gerrit.re.match(r'^/changes/(\d+)/revisions/\d+/related$',
+                                query)
+        if match:
+            return FakeResponse(
+                {'changes': self._related(int(match.group(1)))})
+        match = gerrit.re.match(r'^/changes/(\d+)/', query)
+        if match:
+            return FakeResponse(project_change_object(
+                self.changes[int(match.group(1))], query))
+        match = gerrit.re.match(r'^/changes/\?q=([^&]+)', query)
+        if match:
+            result = []
+            for term in match.group(1).split('+OR+'):
+                conditions = dict(condition.split(':', 1) for condition in
+                                  term.strip('()').split('+'))
+                result.extend([co for co in self.changes.values()
+                               if self._matches(co, conditions)])
+            result = [project_change_object(co, query) for co in result]
+            if self.page_size:
+                start = gerrit.re.search(r'&start=(\d+)', query)
+                start = int(start.group(1)) if start else 0
+                more = len(result) > start + self.page_size
+                result = [dict(co) for co in
+                          result[start:start + self.page_size]]
+                if more:
+                    result[-1]['_more_changes'] = True
+            return FakeResponse(result)
+        raise ValueError("Unsupported query: {}".format(query))
+
+
+class TestGerritQueryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = gerrit.GerritQueryCache(self.cache_dir, 1024 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def put(self, query, result):
+        self.cache.put(query, gerrit.json.dumps(result), result)
+
+    def test_query_class(self):
+        self.assertEqual(
+            self.cache.query_class('/changes/1234/?o=ALL_REVISIONS'),
+            'change')
+        self.assertEqual(
+            self.cache.query_class('/changes/1234/revisions/2/related'),
+            'related')
+        self.assertEqual(
+            self.cache.query_class('/changes/?q=is:open'), 'query')
+        self.assertEqual(
+            self.cache.query_class('/projects/ardana%2Fx/branches/master'),
+            'project')
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get('/changes/1/'))
+        self.put('/changes/1/', change_object(1, '2019-01-01 00:00:00'))
+        self.assertEqual(
+            gerrit.json.loads(self.cache.get('/changes/1/'))['_number'], 1)
+
+    def test_updated_invalidation(self):
+        self.put('/changes/1/', change_object(1, '2019-01-01 00:00:00'))
+        self.put('/changes/1/revisions/1/related', {'changes': []})
+        self.assertIsNotNone(self.cache.get('/changes/1/revisions/1/related'))
+        # A more recent version of the change is returned by another query
+        self.put('/changes/?q=is:open',
+                 [change_object(1, '2019-01-02 00:00:00'),
+                  change_object(2, '2019-01-01 00:00:00')])
+        self.assertIsNone(self.cache.get('/changes/1/'))
+        self.assertIsNone(self.cache.get('/changes/1/revisions/1/related'))
+        # Change set query responses are not cached
+        self.assertIsNone(self.cache.get('/changes/?q=is:open'))
+
+    def test_invalidate(self):
+        self.put('/changes/1/', change_object(1, '2019-01-01 00:00:00'))
+        self.put('/changes/2/', change_object(2, '2019-01-01 00:00:00'))
+        self.cache.invalidate(1)
+        self.assertIsNone(self.cache.get('/changes/1/'))
+        self.assertIsNotNone(self.cache.get('/changes/2/'))
+        self.put('/changes/1/', change_object(1, '2019-01-01 00:00:00'))
+        self.assertIsNotNone(self.cache.get('/changes/1/'))
+
+    def test_lru_eviction(self):
+        self.cache.max_size = 400
+        for number in range(1, 4):
+            self.put('/changes/{}/'.format(number),
+                     dict(change_object(number, '2019-01-01 00:00:00'),
+                          subject='x' * 100))
+            # Keep the first change recently used
+            self.cache.get('/changes/1/')
+        self.assertIsNotNone(self.cache.get('/changes/1/'))
+        self.assertIsNone(self.cache.get('/changes/2/'))
+        self.assertIsNotNone(self.cache.get('/changes/3/'))
+
+
+class GerritTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.gerrit = FakeGerrit()
+        self._disk_cache = gerrit.GerritApiCaller._DISK_CACHE
+        self._session = gerrit.GerritApiCaller._SESSION
+        gerrit.GerritApiCaller._DISK_CACHE = None
+        gerrit.GerritApiCaller._SESSION = self.gerrit
+        gerrit.GerritApiCaller._CACHE.clear()
+        gerrit.GerritApiCaller._CACHE_CREATED.clear()
+
+    def tearDown(self):
+        gerrit.GerritApiCaller._DISK_CACHE = self._disk_cache
+        gerrit.GerritApiCaller._SESSION = self._session
+        gerrit.GerritApiCaller._CACHE.clear()
+        gerrit.GerritApiCaller._CACHE_CREATED.clear()
+
+
+class TestGerritApiCallerCache(GerritTestCase):
+
+    def tearDown(self):
+        super(TestGerritApiCallerCache, self).tearDown()
+        gerrit.GerritApiCaller._CACHE_EXPIRY = False
+
+    def test_cache_expiry(self):
+        self.gerrit.add_change(1)
+        gerrit.GerritChange('1')
+        gerrit.GerritChange('1')
+        self.assertEqual(len(self.gerrit.queries), 1)
+        gerrit.GerritApiCaller.enable_cache_expiry()
+        for query in gerrit.GerritApiCaller._CACHE_CREATED:
+            gerrit.GerritApiCaller._CACHE_CREATED[query] -= 3600
+        gerrit.GerritChange('1')
+        self.assertEqual(len(self.gerrit.queries), 2)
+        gerrit.GerritApiCaller.purge_expired_cache()
+        self.assertEqual(len(gerrit.GerritApiCaller._CACHE), 1)
+
+    def test_invalidate_change(self):
+        self.gerrit.add_change(1)
+        self.gerrit.add_change(2)
+        gerrit.GerritChange.get_changes(['1', '2'])
+        gerrit.GerritChangeSet('status:open')
+        gerrit.GerritApiCaller._invalidate_change(1)
+        # Only the responses not including change 1 are left
+        self.assertEqual(sorted(gerrit.GerritApiCaller._CACHE),
+                         sorted(gerrit.GerritApiCaller._CACHE_CREATED))
+        self.assertTrue(all(query.startswith('/changes/2/')
+                            for query in gerrit.GerritApiCaller._CACHE))
+
+
+class TestGerritChangeDependencies(GerritTestCase):
+
+    def setUp(self):
+        super(TestGerritChangeDependencies, self).setUp()
+        self.gerrit.add_change(1)
+        self.gerrit.add_change(2, parent=1)
+        self.gerrit.add_change(3, parent=2, depends_on=[
+            'https://gerrit.prv.suse.net/4'])
+        self.gerrit.add_change(4, project='ardana/other', depends_on=[
+            'I{:040x}'.format(5), 'https://gerrit.prv.suse.net/1'])
+        self.gerrit.add_change(5, project='ardana/another', status='MERGED')
+
+    def test_get_dependencies(self):
+        change = gerrit.GerritChange('3')
+        self.assertEqual(
+            [c.id for c in change.get_dependencies()],
+            ['2', '1', '4', '5'])
+
+    def test_get_dependencies_sequential(self):
+        change = gerrit.GerritChange('3')
+        concurrent_map = gerrit.concurrent_map
+        concurrency_values = set()
+
+        def recording_concurrent_map(func, items, concurrency=None):
+            concurrency_values.add(concurrency)
+            return concurrent_map(func, items, concurrency)
+
+        gerrit.concurrent_map = recording_concurrent_map
+        try:
+            self.assertEqual(
+                [c.id for c in change.get_dependencies(concurrency=1)],
+                ['2', '1', '4', '5'])
+        finally:
+            gerrit.concurrent_map = concurrent_map
+        # The limit also applies to the queries issued for each change
+        self.assertEqual(concurrency_values, set([1]))
+
+    def test_get_implicit_references(self):
+        change = gerrit.GerritChange('1')
+        self.assertEqual(
+            [c.id for c in change.get_implicit_references()],
+            ['2', '3'])
+
+    def test_queries_run_once(self):
+        gerrit.GerritChange('3').get_dependencies()
+        self.assertEqual(len(self.gerrit.queries),
+                         len(set(self.gerrit.queries)))
+
+    def test_get_changes(self):
+        changes = gerrit.GerritChange.get_changes(
+            ['4', 'I{:040x}'.format(5), '1/1', '4'], 'master')
+        self.assertEqual([c.id for c in changes], ['4', '5', '1', '4'])
+        self.assertEqual(len(self.gerrit.queries), 1)
+        # Changes are also cached individually
+        gerrit.GerritChange('4')
+        self.assertEqual(len(self.gerrit.queries), 1)
+
+    def test_get_changes_chunks(self):
+        for number in range(6, 60):
+            self.gerrit.add_change(number)
+        changes = gerrit.GerritChange.get_changes(
+            [str(number) for number in range(1, 60)])
+        self.assertEqual([c.id for c in changes],
+                         [str(number) for number in range(1, 60)])
+        self.assertEqual(len(self.gerrit.queries), 3)
+
+    def test_lazy_revision_loading(self):
+        change = gerrit.GerritChange('4')
+        self.assertEqual(change.status, 'NEW')
+        self.assertEqual(change.gerrit_project, 'other')
+        self.assertEqual(self.gerrit.queries, ['/changes/4/'])
+        self.assertEqual(change.patchset, '1')
+        self.assertTrue(change.is_current)
+        self.assertEqual(len(self.gerrit.queries), 2)
+        self.assertIn('o=CURRENT_REVISION', self.gerrit.queries[1])
+
+    def test_get_changes_not_found(self):
+        self.assertRaises(Exception,
+                          gerrit.GerritChange.get_changes, ['4', '100'])
+        self.assertRaises(Exception,
+                          gerrit.GerritChange.get_changes, ['4'], 'other')
+
+
+class TestGerritReferenceIndex(GerritTestCase):
+
+    def setUp(self):
+        super(TestGerritReferenceIndex, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.gerrit.add_change(1)
+        self.gerrit.add_change(2, depends_on=[
+            'https://gerrit.prv.suse.net/1'])
+        self.gerrit.add_change(3, depends_on=['I{:040x}'.format(1)])
+        self.gerrit.add_change(4, depends_on=[
+            'https://gerrit.prv.suse.net/2'], status='ABANDONED')
+
+    def tearDown(self):
+        super(TestGerritReferenceIndex, self).tearDown()
+        shutil.rmtree(self.cache_dir)
+
+    def get_references(self, index, number):
+        return sorted(int(c.id) for c in index.get_references(
+            gerrit.GerritChange(str(number))))
+
+    def test_get_references(self):
+        index = gerrit.GerritReferenceIndex('master', self.cache_dir)
+        self.assertEqual(self.get_references(index, 1), [2, 3])
+        self.assertEqual(self.get_references(index, 2), [])
+
+    def test_incremental_sync(self):
+        index = gerrit.GerritReferenceIndex('master', self.cache_dir)
+        self.assertEqual(len(self.gerrit.queries), 1)
+        self.gerrit.add_change(5, depends_on=[
+            'https://gerrit.prv.suse.net/1'])
+        self.gerrit.changes[3]['status'] = 'MERGED'
+        gerrit.GerritApiCaller._CACHE.clear()
+        # The index is loaded from disk and only updated changes are queried
+        index = gerrit.GerritReferenceIndex('master', self.cache_dir)
+        self.assertIn('-age:', self.gerrit.queries[1])
+        self.assertEqual(self.get_references(index, 1), [2, 5])
+
+    def test_paged_sync(self):
+        self.gerrit.page_size = 2
+        for number in range(5, 10):
+            self.gerrit.add_change(number, depends_on=[
+                'https://gerrit.prv.suse.net/1'])
+        index = gerrit.GerritReferenceIndex('master', self.cache_dir)
+        # The open changes are returned two at a time
+        self.assertEqual(len(self.gerrit.queries), 4)
+        self.assertIn('&start=6', self.gerrit.queries[-1])
+        self.assertEqual(self.get_references(index, 1),
+                         [2, 3, 5, 6, 7, 8, 9])
+
+    def test_update_change(self):
+        index = gerrit.GerritReferenceIndex('master', self.cache_dir)
+        self.gerrit.add_change(2)
+        gerrit.GerritApiCaller._CACHE.clear()
+        index.update_change(gerrit.GerritChange('2'))
+        self.assertEqual(self.get_references(index, 1), [3])
+
+
+class TestMergeChanges(GerritTestCase):
+
+    def setUp(self):
+        super(TestMergeChanges, self).setUp()
+        project = 'ardana/ardana-ansible'
+        self.gerrit.add_change(1, project=project, status='MERGED')
+        self.gerrit.add_change(2, project=project, parent=1)
+        self.gerrit.add_change(3, project=project, parent=2)
+        self.gerrit.add_change(6, project=project)
+        self.gerrit.add_change(4, project='ardana/ardana-input-model',
+                               depends_on=['https://gerrit.prv.suse.net/1',
+                                           'https://gerrit.prv.suse.net/6'])
+        self.gerrit.add_change(5, project='ardana/ardana-input-model',
+                               parent=4)
+        for change in self.gerrit.changes.values():
+            change.update(mergeable=True, submittable=True)
+        self.merged = []
+        self._merge = gerrit.GerritChange.merge
+        gerrit.GerritChange.merge = lambda change: self.merged.append(
+            change.id)
+
+    def tearDown(self):
+        super(TestMergeChanges, self).tearDown()
+        gerrit.GerritChange.merge = self._merge
+
+    def test_merge_changes(self):
+        changes = gerrit.GerritChange.get_changes(['3', '5', '2', '4'])
+        results = gerrit_merge.merge_changes(changes, dry_run=True)
+        self.assertEqual(results, {'2': 'merged', '3': 'merged',
+                                   '4': 'failed', '5': 'blocked'})
+
+    def test_merge_order(self):
+        changes = gerrit.GerritChange.get_changes(['3', '2'])
+        gerrit_merge.merge_changes(changes)
+        self.assertEqual(self.merged, ['2', '3'])
+
+    def test_merge_error(self):
+        def merge(change):
+            if change.id == '2':
+                raise gerrit.requests.HTTPError('409 Client Error: Conflict')
+            self.merged.append(change.id)
+        gerrit.GerritChange.merge = merge
+        changes = gerrit.GerritChange.get_changes(['3', '2', '6'])
+        results = gerrit_merge.merge_changes(changes)
+        self.assertEqual(results, {'2': 'failed', '3': 'blocked',
+                                   '6': 'merged'})
+        self.assertEqual(self.merged, ['6'])
+
+
+class FakeTime(object):
+    """
+    Stand-in for the time module, with a clock that only advances when
+    sleeping.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+class FakeReviewChange(object):
+
+    def __init__(self, number):
+        self.id = str(number)
+
+
+class TestReviewChanges(unittest.TestCase):
+
+    def setUp(self):
+        self.time = FakeTime()
+        self._time = gerrit_review.time
+        self._gerrit_review = gerrit_review.gerrit_review
+        gerrit_review.time = self.time
+        gerrit_review.gerrit_review = self.review
+        self.attempts = {}
+        # Errors raised when posting reviews, per change number
+        self.errors = {}
+
+    def tearDown(self):
+        gerrit_review.time = self._time
+        gerrit_review.gerrit_review = self._gerrit_review
+
+    def review(self, change, label=None, vote=1, message=''):
+        self.attempts[change.id] = self.attempts.get(change.id, 0) + 1
+        errors = self.errors.get(change.id, [])
+        if errors:
+            raise errors.pop(0)
+        return 1 if change.id == '2' else 0
+
+    def test_rate_limiter(self):
+        rate_limiter = gerrit_review.RateLimiter(4)
+        for _ in range(5):
+            rate_limiter.wait()
+        self.assertEqual(self.time.sleeps, [0.25, 0.25, 0.25, 0.25])
+        rate_limiter = gerrit_review.RateLimiter(0)
+        rate_limiter.wait()
+        rate_limiter.wait()
+        self.assertEqual(len(self.time.sleeps), 4)
+
+    def test_review_results(self):
+        requests = gerrit_review.requests
+        server_error = requests.HTTPError('503 Server Error')
+        server_error.response = requests.Response()
+        server_error.response.status_code = 503
+        self.errors = {
+            '3': [requests.ConnectionError('Connection refused')],
+            '4': [requests.ReadTimeout('Read timed out')],
+            '5': [server_error],
+        }
+        reviews = [(FakeReviewChange(number), 'Verified', 1, '')
+                   for number in range(1, 6)]
+        results = gerrit_review.gerrit_review_changes(
+            reviews, concurrency=1, rate=0)
+        self.assertEqual(results, {
+            '1': 'posted', '2': 'skipped', '3': 'failed', '4': 'failed',
+            '5': 'failed'})
+        # Failed reviews are not retried on top of the HTTP session retries
+        self.assertEqual(self.attempts, {
+            '1': 1, '2': 1, '3': 1, '4': 1, '5': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import gerrit
+
+import gerrit_event_daemon
+
+
+def event(event_type, number, project='ardana/ardana-ansible', **kwargs):
+    result = {
+        'type': event_type,
+        'change': {'number': number, 'project': project, 'branch': 'master'},
+    }
+    result.update(kwargs)
+    return json.dumps(result)
+
+
+# Events recorded from the Gerrit event stream, stripped down to the fields
+# used by the daemon
+RECORDED_EVENTS = [
+    event('patchset-created', 1, patchSet={'number': 1}),
+    event('comment-added', 1, comment='Patch Set 1: Code-Review+2'),
+    event('patchset-created', 1, patchSet={'number': 2}),
+    event('comment-added', 1, comment='Patch Set 2: Workflow+1'),
+    event('comment-added', 1, comment='Patch Set 2: looks good'),
+    event('patchset-created', 2, patchSet={'number': 1}),
+    event('patchset-created', 2, patchSet={'number': 2, 'isDraft': True}),
+    event('change-merged', 3),
+    event('patchset-created', 4, project='ardana/untracked-project',
+          patchSet={'number': 1}),
+    'not a JSON event',
+]
+
+
+class FakeChange(object):
+
+    def __init__(self, number, refresh=False):
+        self.id = str(number)
+        self.branch = 'master'
+
+
+class FakeReferenceIndex(object):
+
+    def update_change(self, change, save=True):
+        pass
+
+
+class TestEventDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.handled = []
+        self.active = {}
+        self.max_active = {}
+        self.lock = threading.Lock()
+        self.handling_time = 0
+        self.patched = {
+            'GerritChange': FakeChange,
+            'handle_change_merged': self.handler('merged'),
+            'handle_change_updated': self.handler('updated'),
+            'gerrit_merge': self.handler('merge'),
+        }
+        self.originals = dict((name, getattr(gerrit_event_daemon, name))
+                              for name in self.patched)
+        for name, value in self.patched.items():
+            setattr(gerrit_event_daemon, name, value)
+        self.reference_index = gerrit_event_daemon.EventDispatcher.\
+            _reference_index
+        gerrit_event_daemon.EventDispatcher._reference_index = \
+            lambda dispatcher, branch: FakeReferenceIndex()
+        self.cache_expiry = gerrit.GerritApiCaller._CACHE_EXPIRY
+
+    def tearDown(self):
+        for name, value in self.originals.items():
+            setattr(gerrit_event_daemon, name, value)
+        gerrit_event_daemon.EventDispatcher._reference_index = \
+            self.reference_index
+        gerrit.GerritApiCaller._CACHE_EXPIRY = self.cache_expiry
+
+    def handler(self, action):
+        def handle(change, dry_run, reference_index=None):
+            with self.lock:
+                self.active[change.id] = self.active.get(change.id, 0) + 1
+                self.max_active[change.id] = max(
+                    self.max_active.get(change.id, 0),
+                    self.active[change.id])
+                self.max_active['total'] = max(
+                    self.max_active.get('total', 0),
+                    sum(self.active.values()))
+            time.sleep(self.handling_time)
+            with self.lock:
+                self.active[change.id] -= 1
+                self.handled.append((change.id, action))
+        return handle
+
+    def replay(self, dispatcher, events):
+        events_dir = tempfile.mkdtemp()
+        try:
+            events_file = os.path.join(events_dir, 'events')
+            with open(events_file, 'w') as f:
+                f.write('\n'.join(events) + '\n')
+            gerrit_event_daemon.dispatch_events(
+                dispatcher, gerrit_event_daemon.file_event_stream(
+                    events_file))
+        finally:
+            shutil.rmtree(events_dir)
+
+    def test_coalescing(self):
+        dispatcher = gerrit_event_daemon.EventDispatcher(
+            workers=4, debounce=0.2)
+        self.replay(dispatcher, RECORDED_EVENTS)
+        # Nothing is handled before the debounce interval expires
+        self.assertEqual(self.handled, [])
+        dispatcher.stop()
+        self.assertEqual(sorted(self.handled), [
+            ('1', 'merge'), ('1', 'updated'), ('2', 'updated'),
+            ('3', 'merged')])
+        # Actions for the same change are handled in the order they are due
+        self.assertLess(self.handled.index(('1', 'updated')),
+                        self.handled.index(('1', 'merge')))
+
+    def test_events_during_handling(self):
+        self.handling_time = 0.2
+        dispatcher = gerrit_event_daemon.EventDispatcher(
+            workers=4, debounce=0)
+        self.replay(dispatcher, RECORDED_EVENTS[:1])
+        time.sleep(0.1)
+        # Events received while the change is being handled are coalesced
+        # and handled afterwards
+        self.replay(dispatcher, RECORDED_EVENTS[:4])
+        dispatcher.stop()
+        self.assertEqual(self.handled, [
+            ('1', 'updated'), ('1', 'updated'), ('1', 'merge')])
+
+    def test_per_change_serialization(self):
+        self.handling_time = 0.05
+        dispatcher = gerrit_event_daemon.EventDispatcher(
+            workers=4, debounce=0)
+        for _ in range(5):
+            self.replay(dispatcher, RECORDED_EVENTS)
+            time.sleep(0.02)
+        dispatcher.stop(flush=True)
+        self.assertEqual(self.max_active['1'], 1)
+        self.assertEqual(self.max_active['2'], 1)
+        self.assertEqual(self.max_active['3'], 1)
+        # Different changes are still handled concurrently
+        self.assertGreater(self.max_active['total'], 1)
+        self.assertEqual(set(self.handled), set([
+            ('1', 'merge'), ('1', 'updated'), ('2', 'updated'),
+            ('3', 'merged')]))
+
+
+if __name__ == '__main__':
+    unittest.main()
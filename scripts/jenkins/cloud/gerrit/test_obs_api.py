@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+import sys
+import threading
+import unittest
+
+import obs_api
+
+if sys.version_info[0] < 3:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+else:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+class FakeOBSHandler(BaseHTTPRequestHandler):
+    """
+    Serves a fixed set of OBS API responses
+    """
+
+    responses = {
+        '/source/Cloud:9':
+            '<directory count="2"><entry name="ardana-ansible"/>'
+            '<entry name="ardana-db"/></directory>',
+        '/source/Cloud:9/ardana-db/_service?expand=1': '<services/>',
+        '/build/Cloud:9/_result?package=ardana-db':
+            '<resultlist><result project="Cloud:9" repository="standard" '
+            'arch="x86_64" code="published" state="published">'
+            '<status package="ardana-db" code="succeeded"/>'
+            '</result></resultlist>',
+    }
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get('Authorization')))
+        body = self.responses.get(self.path)
+        self.send_response(200 if body is not None else 404)
+        self.end_headers()
+        if body is not None:
+            self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+class TestOBSApi(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FakeOBSHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        del FakeOBSHandler.requests[:]
+        self.api = obs_api.OBSApi(
+            'http://127.0.0.1:%d/' % self.server.server_address[1],
+            auth=('user', 'password'))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_list_packages(self):
+        self.assertEqual(self.api.list_packages('Cloud:9'),
+                         ['ardana-ansible', 'ardana-db'])
+        self.assertTrue(FakeOBSHandler.requests[0][1].startswith('Basic '))
+
+    def test_cat(self):
+        self.assertEqual(self.api.cat('Cloud:9', 'ardana-db', '_service'),
+                         '<services/>')
+
+    def test_build_results(self):
+        self.assertIn('code="succeeded"', self.api.build_results(
+            'Cloud:9', package='ardana-db'))
+
+    def test_not_found(self):
+        self.assertRaises(obs_api.requests.HTTPError,
+                          self.api.meta, 'Cloud:9', 'missing')
+
+
+if __name__ == '__main__':
+    unittest.main()